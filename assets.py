@@ -0,0 +1,187 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies the stylesheets, scripts and images under
+static/ into static/build/ with a hash of their contents in the name --
+stylesheets/style.css becomes build/stylesheets/style.1a2b3c4d5e6f.css --
+writes gzip and brotli copies next to them, and records the mapping in
+static/build/manifest.json.
+
+Once built, `url_for('static', filename='stylesheets/style.css')` resolves
+to the hashed name. A hashed file's contents can never change, so it is
+served with a year-long immutable Cache-Control and, when the browser
+accepts it, precompressed. Before a build (e.g. in development) there is no
+manifest and static files are served at their plain names, revalidated as
+usual.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # optional; without it only .gz copies are written
+    brotli = None
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+
+# Images go first so stylesheets can be rewritten to their hashed names.
+ASSET_PATTERNS = [
+    re.compile(r'images/[^/]+'),
+    re.compile(r'stylesheets/[^/]+\.css'),
+    re.compile(r'[^/]+\.js'),
+    re.compile(r'favicon\.ico'),
+]
+
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Only keep a compressed copy if it is meaningfully smaller (images are
+# usually compressed already).
+MIN_COMPRESSION_RATIO = 0.9
+
+
+def compressors():
+    """(Content-Encoding, file suffix, compress function), best first."""
+
+    found = []
+    if brotli is not None:
+        found.append(('br', '.br', lambda data: brotli.compress(data, quality=11)))
+    found.append(('gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0)))
+    return found
+
+
+def build_assets(static_folder):
+    """Write hashed, precompressed copies of the assets in `static_folder`.
+
+    Replaces any earlier build. Returns the manifest, which maps each
+    asset's name to {"path": hashed name, "encodings": [...]}.
+    """
+
+    build_dir = os.path.join(static_folder, BUILD_DIR)
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+    names = []
+    for dirpath, _, filenames in os.walk(static_folder):
+        for filename in filenames:
+            names.append(os.path.relpath(os.path.join(dirpath, filename),
+                                         static_folder).replace(os.sep, '/'))
+
+    manifest = {}
+
+    for pattern in ASSET_PATTERNS:
+        for name in sorted(names):
+            if not pattern.fullmatch(name):
+                continue
+
+            with open(os.path.join(static_folder, name), 'rb') as f:
+                data = f.read()
+
+            if name.endswith('.css'):
+                data = rewrite_urls(data, manifest)
+
+            root, ext = os.path.splitext(name)
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            path = f"{BUILD_DIR}/{root}.{digest}{ext}"
+
+            write_file(os.path.join(static_folder, path), data)
+
+            encodings = []
+            for encoding, suffix, compress in compressors():
+                compressed = compress(data)
+                if len(compressed) < len(data) * MIN_COMPRESSION_RATIO:
+                    write_file(os.path.join(static_folder, path + suffix), compressed)
+                    encodings.append(encoding)
+
+            manifest[name] = {'path': path, 'encodings': encodings}
+
+    write_file(os.path.join(build_dir, MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    return manifest
+
+
+def rewrite_urls(css, manifest):
+    """Point /static/... URLs in `css` at the hashed files in `manifest`."""
+
+    def hashed(match):
+        entry = manifest.get(match.group(2))
+        if entry is None:
+            return match.group(0)
+        return f"{match.group(1)}/static/{entry['path']}"
+
+    return re.sub(r"""(url\(\s*["']?)/static/([^"')\s]+)""", hashed, css.decode()).encode()
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class Assets:
+    """Serve the latest `build_assets` output in place of plain static files."""
+
+    def __init__(self):
+        self.manifest = {}
+        self._by_path = {}
+
+    def init_app(self, app):
+        """Load the manifest, if built, and take over the static route."""
+
+        self.load(app.static_folder)
+        app.url_defaults(self.hashed_url)
+        app.view_functions['static'] = self.send_static
+
+    def load(self, static_folder):
+        """(Re)read the manifest from `static_folder`."""
+
+        try:
+            with open(os.path.join(static_folder, BUILD_DIR, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+        self._by_path = {entry['path']: entry for entry in self.manifest.values()}
+
+    def hashed_url(self, endpoint, values):
+        """url_defaults hook: swap static filenames for their hashed ones."""
+
+        if endpoint == 'static':
+            entry = self.manifest.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = entry['path']
+
+    def send_static(self, filename):
+        """The static route: hashed files cached for good, precompressed if
+        the client accepts it; anything else as Flask normally would."""
+
+        entry = self._by_path.get(filename)
+        if entry is None:
+            return current_app.send_static_file(filename)
+
+        variant, encoding = filename, None
+        for candidate, suffix, _ in compressors():
+            if candidate in entry['encodings'] and candidate in request.accept_encodings:
+                variant, encoding = filename + suffix, candidate
+                break
+
+        response = send_from_directory(current_app.static_folder, variant,
+                                       mimetype=mimetypes.guess_type(filename)[0],
+                                       max_age=ONE_YEAR)
+        if encoding:
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
+
+
+assets = Assets()
@@ -0,0 +1,62 @@
+"""Benchmark password checks (logins/sec) at several bcrypt costs.
+
+Runs the same `PasswordHasher` the app uses, with its worker pool, so the
+numbers reflect what one app process can sustain:
+
+    python benchmarks/bcrypt_logins.py --costs 10 11 12 13 --workers 4
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from passwords import PasswordHasher  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+
+
+def logins_per_second(cost, workers, seconds):
+    """Check passwords at `cost` for about `seconds`; return the rate."""
+
+    hasher = PasswordHasher(rounds=cost, max_workers=workers, max_queue=workers)
+    hashed = hasher.hash(PASSWORD)
+
+    deadline = time.perf_counter() + seconds
+
+    def login_until_deadline():
+        logins = 0
+        while time.perf_counter() < deadline:
+            hasher.check(hashed, PASSWORD)
+            logins += 1
+        return logins
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as clients:
+        counts = [clients.submit(login_until_deadline) for _ in range(workers)]
+    elapsed = time.perf_counter() - start
+
+    return sum(count.result() for count in counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--costs', type=int, nargs='+', default=[10, 11, 12, 13])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+
+    results = {
+        str(cost): round(logins_per_second(cost, args.workers, args.seconds), 2)
+        for cost in args.costs
+    }
+
+    print(json.dumps({'workers': args.workers, 'logins_per_sec': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
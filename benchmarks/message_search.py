@@ -0,0 +1,120 @@
+"""Benchmark message search latency.
+
+By default this builds the in-process inverted index over synthetic
+messages -- word frequencies follow a Zipf curve, like real text -- and
+times one- and two-word queries against it:
+
+    python benchmarks/message_search.py --messages 1000000
+
+With --database it instead times `search_messages` end to end against the
+messages already in DATABASE_URL (tsvector/GIN on Postgres), picking query
+words from a sample of those messages.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from search import InvertedIndex, tokenize  # noqa: E402
+
+VOCABULARY_SIZE = 20_000
+
+
+def synthetic_messages(count, rng):
+    """Yield (id, text) for `count` made-up messages."""
+
+    vocabulary = [f"w{rank}" for rank in range(1, VOCABULARY_SIZE + 1)]
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY_SIZE + 1)))
+    for id in range(1, count + 1):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 20))
+        yield id, " ".join(words)
+
+
+def percentiles(samples):
+    """p50/p95/p99 of `samples` (seconds), in milliseconds."""
+
+    cuts = statistics.quantiles(samples, n=100)
+    return {name: round(cuts[index] * 1000, 3)
+            for name, index in [('p50', 49), ('p95', 94), ('p99', 98)]}
+
+
+def time_queries(search, queries):
+    """Run each query through `search`; return per-query latencies."""
+
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_index(args, rng):
+    index = InvertedIndex()
+
+    start = time.perf_counter()
+    for id, text in synthetic_messages(args.messages, rng):
+        index.add(id, text)
+    build_seconds = time.perf_counter() - start
+
+    # Common, middling and rare words, alone and in pairs.
+    words = [f"w{rng.choice(band)}" for band in
+             (range(1, 50), range(50, 2000), range(2000, VOCABULARY_SIZE))
+             for _ in range(args.queries // 6 or 1)]
+    queries = words + [f"{a} {b}" for a, b in zip(words, reversed(words))]
+
+    latencies = time_queries(
+        lambda query: index.search(tokenize(query), limit=args.limit), queries)
+
+    return {'backend': 'index', 'messages': len(index),
+            'build_seconds': round(build_seconds, 2),
+            'queries': len(queries), 'latency_ms': percentiles(latencies)}
+
+
+def bench_database(args, rng):
+    from app import create_app
+    from models import db, Message
+    from search import search_messages, uses_database_search, build_message_index
+
+    create_app().app_context().push()
+
+    if not uses_database_search():
+        build_message_index()
+
+    sample = db.session.scalars(
+        db.select(Message.text).order_by(db.func.random()).limit(args.queries)).all()
+    words = [rng.choice(tokenize(text) or ['warble']) for text in sample]
+    queries = words + [f"{a} {b}" for a, b in zip(words, reversed(words))]
+
+    latencies = time_queries(
+        lambda query: search_messages(query, limit=args.limit), queries)
+
+    return {'backend': db.session.get_bind().dialect.name,
+            'messages': db.session.scalar(db.select(db.func.count(Message.id))),
+            'queries': len(queries), 'latency_ms': percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', action='store_true')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    results = bench_database(args, rng) if args.database else bench_index(args, rng)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
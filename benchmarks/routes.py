@@ -0,0 +1,290 @@
+"""Benchmark the app's routes end to end.
+
+Seeds a dataset with generator/create_csvs.py and seed.py, then drives each
+route through `app.test_client()` -- first one request at a time, then from
+--workers concurrent clients -- and prints p50/p95/p99 latency, throughput
+and SQL statements per request for every route as JSON:
+
+    python benchmarks/routes.py --scale 10
+    python benchmarks/routes.py --scale 10 --save-baseline baseline.json
+    python benchmarks/routes.py --scale 10 --baseline baseline.json
+
+Seeding DROPS ALL TABLES in DATABASE_URL. If it isn't set, a scratch SQLite
+database is used. Pass --no-seed to reuse an already-seeded database.
+
+With --baseline, each route is compared against the saved results and the
+script exits with status 1 if any got slower than --tolerance allows or
+started running more SQL.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+PASSWORD = "benchmark-password"
+
+# SQL per request is an average over randomly chosen pages, and warm caches
+# skip some queries, so allow a little noise before calling it a regression.
+SQL_TOLERANCE = 0.05
+
+
+def seed(scale, seed_value, database_url):
+    """Generate CSVs at `scale` and load them into `database_url`."""
+
+    env = dict(os.environ, DATABASE_URL=database_url)
+
+    with tempfile.TemporaryDirectory() as csv_dir:
+        subprocess.run([sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+                        '--scale', str(scale), '--seed', str(seed_value), '--out', csv_dir],
+                       check=True, env=env, stdout=sys.stderr)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'seed.py'), '--dir', csv_dir],
+                       check=True, env=env, cwd=ROOT, stdout=sys.stderr)
+
+
+class StatementCounter:
+    """Count SQL statements per thread, so concurrent clients don't mix."""
+
+    def __init__(self, engine):
+        self._local = threading.local()
+        event.listen(engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def reset(self):
+        self._local.count = 0
+
+    def _record(self, *args):
+        self._local.count = self.count + 1
+
+
+def percentiles(samples):
+    """p50/p95/p99 of `samples` (seconds), in milliseconds."""
+
+    cuts = statistics.quantiles(samples, n=100)
+    return {name: round(cuts[index] * 1000, 3)
+            for name, index in [('p50', 49), ('p95', 94), ('p99', 98)]}
+
+
+class Dataset:
+    """Ids to aim requests at, read from the seeded database."""
+
+    def __init__(self, db, User, Message):
+        self.user_ids = db.session.scalars(db.select(User.id)).all()
+        self.message_ids = db.session.scalars(
+            db.select(Message.id).order_by(db.func.random()).limit(10_000)).all()
+        self.usernames = db.session.scalars(
+            db.select(User.username).order_by(db.func.random()).limit(1_000)).all()
+        self.words = [word for text in db.session.scalars(
+                          db.select(Message.text).order_by(db.func.random()).limit(200))
+                      for word in text.split() if len(word) > 3]
+
+
+def scenarios(data, login_username):
+    """{route: function(client, rng) making one request}."""
+
+    def get(path):
+        return lambda client, rng: client.get(path(rng))
+
+    return {
+        'homepage': get(lambda rng: "/"),
+        'api_timeline': get(lambda rng: "/api/timeline"),
+        'users_show': get(lambda rng: f"/users/{rng.choice(data.user_ids)}"),
+        'show_following': get(lambda rng: f"/users/{rng.choice(data.user_ids)}/following"),
+        'users_followers': get(lambda rng: f"/users/{rng.choice(data.user_ids)}/followers"),
+        'show_likes': get(lambda rng: f"/users/{rng.choice(data.user_ids)}/likes"),
+        'list_users': get(lambda rng: f"/users?q={rng.choice(data.usernames)[:3]}"),
+        'users_typeahead': get(lambda rng: f"/api/users/typeahead?q={rng.choice(data.usernames)[:2]}"),
+        'messages_show': get(lambda rng: f"/messages/{rng.choice(data.message_ids)}"),
+        'messages_search': get(lambda rng: f"/messages/search?q={rng.choice(data.words or ['warble'])}"),
+        'add_like': lambda client, rng: client.post(
+            f"/messages/{rng.choice(data.message_ids)}/like"),
+        'messages_add': lambda client, rng: client.post(
+            "/messages/new", data={"text": f"Benchmark warble {rng.random()}"}),
+        'login': lambda client, rng: client.post(
+            "/login", data={"username": login_username, "password": PASSWORD}),
+    }
+
+
+def run_route(app, counter, request, viewer_ids, requests, workers, seed_value):
+    """Make `requests` requests with `workers` concurrent clients.
+
+    Returns latency percentiles, requests/sec, SQL statements per request
+    and the number of 5xx responses.
+    """
+
+    from app import CURR_USER_KEY
+
+    latencies, statements, errors = [], [], []
+    lock = threading.Lock()
+
+    def client_loop(worker, count):
+        rng = random.Random(f"{seed_value}:{worker}")
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = viewer_ids[worker % len(viewer_ids)]
+
+        mine = []
+        for _ in range(count):
+            counter.reset()
+            start = time.perf_counter()
+            response = request(client, rng)
+            elapsed = time.perf_counter() - start
+            mine.append((elapsed, counter.count, response.status_code >= 500))
+            response.close()
+
+        with lock:
+            for elapsed, count, error in mine:
+                latencies.append(elapsed)
+                statements.append(count)
+                errors.append(error)
+
+    per_worker = max(1, requests // workers)
+    start = time.perf_counter()
+
+    if workers == 1:
+        client_loop(0, per_worker)
+    else:
+        threads = [threading.Thread(target=client_loop, args=(worker, per_worker))
+                   for worker in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    return {
+        'latency_ms': percentiles(latencies),
+        'requests_per_sec': round(len(latencies) / elapsed, 2),
+        'sql_per_request': round(statistics.mean(statements), 2),
+        'errors': sum(errors),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Routes whose p95 or SQL count regressed against `baseline`."""
+
+    regressions = []
+
+    for route, modes in results['routes'].items():
+        for mode, current in modes.items():
+            before = baseline.get('routes', {}).get(route, {}).get(mode)
+            if before is None:
+                continue
+
+            p95, p95_before = current['latency_ms']['p95'], before['latency_ms']['p95']
+            current['p95_vs_baseline'] = round(p95 / p95_before, 2) if p95_before else None
+
+            if p95 > p95_before * (1 + tolerance):
+                regressions.append(f"{route} ({mode}): p95 {p95_before}ms -> {p95}ms")
+            if current['sql_per_request'] > before['sql_per_request'] * (1 + SQL_TOLERANCE):
+                regressions.append(f"{route} ({mode}): SQL per request "
+                                   f"{before['sql_per_request']} -> {current['sql_per_request']}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help="dataset size, as a multiple of the generator's defaults")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-seed', action='store_true',
+                        help="use the data already in DATABASE_URL")
+    parser.add_argument('--profile', default='production',
+                        help="config profile to build the app with (see config.py)")
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per route, per mode")
+    parser.add_argument('--workers', type=int, default=8,
+                        help="concurrent clients for the concurrent mode")
+    parser.add_argument('--routes', nargs='+', help="only these routes")
+    parser.add_argument('--baseline', help="compare against this saved result")
+    parser.add_argument('--save-baseline', help="write the results here")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed p95 slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    scratch = None
+    if 'DATABASE_URL' not in os.environ:
+        scratch = tempfile.TemporaryDirectory()
+        os.environ['DATABASE_URL'] = f"sqlite:///{scratch.name}/benchmark.db"
+
+    if not args.no_seed:
+        seed(args.scale, args.seed, os.environ['DATABASE_URL'])
+
+    from app import create_app
+    from models import db, User, Message
+
+    app = create_app(args.profile)
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.app_context().push()
+
+    data = Dataset(db, User, Message)
+
+    login_user = User.query.filter_by(username="benchmark-login").first()
+    if login_user is None:
+        login_user = User.signup(username="benchmark-login", email="benchmark@example.com",
+                                 password=PASSWORD, image_url=None)
+        db.session.commit()
+
+    rng = random.Random(args.seed)
+    viewer_ids = rng.sample(data.user_ids, min(len(data.user_ids), args.workers))
+    counter = StatementCounter(db.engine)
+
+    routes = scenarios(data, login_user.username)
+    if args.routes:
+        routes = {name: routes[name] for name in args.routes}
+
+    results = {
+        'scale': args.scale,
+        'profile': args.profile,
+        'database': db.engine.dialect.name,
+        'users': len(data.user_ids),
+        'workers': args.workers,
+        'routes': {},
+    }
+
+    for name, request in routes.items():
+        print(f"Benchmarking {name}...", file=sys.stderr)
+        results['routes'][name] = {
+            'serial': run_route(app, counter, request, viewer_ids,
+                                args.requests, 1, args.seed),
+            'concurrent': run_route(app, counter, request, viewer_ids,
+                                    args.requests, args.workers, args.seed),
+        }
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        results['regressions'] = regressions
+
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    db.session.remove()
+    if scratch is not None:
+        scratch.cleanup()
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
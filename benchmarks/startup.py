@@ -0,0 +1,78 @@
+"""Benchmark the cost of starting the app in each config profile.
+
+Each run is a fresh Python process that imports app.py, calls
+`create_app(profile)` and serves one anonymous request to the homepage
+(which doesn't touch the database). Prints the median time of each step,
+and peak memory, per profile as JSON:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --profiles development production
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs in the child process; prints one JSON line of timings.
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+
+import app
+imported = time.perf_counter()
+
+flask_app = app.create_app({profile!r})
+created = time.perf_counter()
+
+response = flask_app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+served = time.perf_counter()
+
+print(json.dumps({{
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'total_ms': (served - start) * 1000,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'debug_toolbar': 'flask_debugtoolbar' in sys.modules,
+}}))
+"""
+
+
+def run_once(profile):
+    output = subprocess.run([sys.executable, '-c', CHILD.format(root=ROOT, profile=profile)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10, help="processes per profile")
+    parser.add_argument('--profiles', nargs='+',
+                        default=['development', 'testing', 'production'])
+    args = parser.parse_args()
+
+    results = {}
+
+    for profile in args.profiles:
+        print(f"Starting {profile} x{args.runs}...", file=sys.stderr)
+        runs = [run_once(profile) for _ in range(args.runs)]
+
+        results[profile] = {
+            name: round(statistics.median(run[name] for run in runs), 1)
+            for name in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms',
+                         'max_rss_mb')
+        }
+        results[profile]['debug_toolbar'] = runs[0]['debug_toolbar']
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
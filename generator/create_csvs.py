@@ -2,13 +2,27 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows:
+
+    python generator/create_csvs.py                        # the checked-in size
+    python generator/create_csvs.py --scale 3333           # ~1M users
+    python generator/create_csvs.py --users 1000000 --follows 50000000
+
+Output only depends on the arguments (including --seed), never on the
+network or the clock. Rows are written as they are generated, so memory
+use doesn't grow with the size of the dataset.
+
+Like real social networks, activity is heavy-tailed: a few "celebrity" users
+have most of the followers and write most of the messages (see `zipf_user`).
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from datetime import datetime
+from math import gcd
+from random import Random
+
 from faker import Faker
 from helpers import get_random_datetime
 
@@ -20,58 +34,182 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
 
-fake = Faker()
+# Timestamps are spread over the YEARS before this date.
+END_DATE = datetime(2023, 10, 1)
+YEARS = 2
 
-# Generate random profile image URLs to use for users
+# Faker is slow, so we draw this many of each kind of value up front and
+# build rows by picking from (and combining) them.
+POOL_SIZE = 5000
 
-image_urls = [
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Random profile image URLs to use for users
+
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images ship with the app, so generating needs no network access.
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+class Pools:
+    """Fake names, sentences and places to build rows from."""
+
+    def __init__(self, seed):
+        fake = Faker()
+        fake.seed_instance(seed)
+
+        self.user_names = [fake.user_name() for _ in range(POOL_SIZE)]
+        self.domains = [fake.free_email_domain() for _ in range(100)]
+        self.sentences = [fake.sentence() for _ in range(POOL_SIZE)]
+        self.paragraphs = [fake.paragraph()[:MAX_WARBLER_LENGTH] for _ in range(POOL_SIZE)]
+        self.cities = [fake.city() for _ in range(POOL_SIZE)]
+
+
+class UserPicker:
+    """Pick user ids from 1..`num_users` with a power-law popularity.
+
+    `zipf_user` draws num_users ** U for uniform U, so the chance of picking
+    the user ranked k is about proportional to 1/k (Zipf's law). Ranks are
+    then scattered over the ids by a permutation drawn from `rng`, so the
+    popular users aren't simply the first rows of users.csv -- and the most
+    followed users aren't also the most prolific writers, which would make
+    timelines (followers x messages) explode.
+    """
+
+    def __init__(self, num_users, rng):
+        self.num_users = num_users
+        self.rng = rng
+
+        # k -> (k * step + offset) mod num_users permutes 0..num_users-1
+        # as long as step is coprime to num_users.
+        self.step = rng.randint(num_users // 3, num_users) or 1
+        while gcd(self.step, num_users) != 1:
+            self.step += 1
+        self.offset = rng.randrange(num_users)
+
+    def zipf_user(self):
+        rank = int(self.num_users ** self.rng.random())
+        return ((rank - 1) * self.step + self.offset) % self.num_users + 1
+
+    def any_user(self):
+        return self.rng.randint(1, self.num_users)
+
+
+def write_users(path, num_users, pools, rng):
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(1, num_users + 1):
+            # Suffixing the row number keeps usernames and emails unique.
+            username = f"{rng.choice(pools.user_names)}{i}"
+
+            users_writer.writerow(dict(
+                email=f"{username}@{rng.choice(pools.domains)}",
+                username=username,
+                image_url=rng.choice(IMAGE_URLS),
+                password=PASSWORD,
+                bio=rng.choice(pools.sentences),
+                header_image_url=rng.choice(HEADER_IMAGE_URLS),
+                location=rng.choice(pools.cities)
+            ))
+
+
+def write_messages(path, num_messages, picker, pools, rng):
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for _ in range(num_messages):
+            messages_writer.writerow(dict(
+                text=rng.choice(pools.paragraphs),
+                timestamp=get_random_datetime(rng, END_DATE, YEARS),
+                user_id=picker.zipf_user()
+            ))
+
+
+def write_follows(path, num_users, num_follows, picker, rng):
+    """Write about `num_follows` follows; return how many were written.
+
+    Each user follows a random number of others -- on average
+    num_follows / num_users -- chosen by popularity, so followers pile up
+    on the celebrities. Only one user's follows are held at a time.
+    """
+
+    mean_following = num_follows / num_users
+    count = 0
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.writer(follows_csv)
+        follows_writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for follower in range(1, num_users + 1):
+            wanted = min(num_users - 1,
+                         round(rng.expovariate(1 / mean_following)) if mean_following else 0)
+            following = set()
+
+            # Popular users get picked again and again; after a few misses,
+            # fill up with users picked uniformly instead.
+            for _ in range(wanted * 4):
+                if len(following) == wanted:
+                    break
+                followed = picker.zipf_user()
+                if followed != follower:
+                    following.add(followed)
+
+            while len(following) < wanted:
+                followed = picker.any_user()
+                if followed != follower:
+                    following.add(followed)
+
+            follows_writer.writerows((followed, follower) for followed in sorted(following))
+            count += len(following)
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help="multiply the default row counts by this")
+    parser.add_argument('--users', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--follows', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.dirname(__file__) or '.',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    num_users = args.users or round(NUM_USERS * args.scale)
+    num_messages = args.messages or round(NUM_MESSAGES * args.scale)
+    num_follows = args.follows or round(NUM_FOLLOWS * args.scale)
+
+    # Separate generators per file, so changing one count doesn't change
+    # the rows of the other files.
+    pools = Pools(args.seed)
+    users_rng, messages_rng, follows_rng = (Random(f"{args.seed}:{name}")
+                                            for name in ('users', 'messages', 'follows'))
+
+    write_users(os.path.join(args.out, 'users.csv'), num_users, pools, users_rng)
+    write_messages(os.path.join(args.out, 'messages.csv'), num_messages,
+                   UserPicker(num_users, messages_rng), pools, messages_rng)
+    written = write_follows(os.path.join(args.out, 'follows.csv'), num_users, num_follows,
+                            UserPicker(num_users, follows_rng), follows_rng)
+
+    print(f"Wrote {num_users:,} users, {num_messages:,} messages and {written:,} follows "
+          f"to {args.out}.")
+
+
+if __name__ == '__main__':
+    main()
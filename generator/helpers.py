@@ -1,14 +1,13 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from datetime import timedelta
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, end, year_gap=2):
+    """Get a random datetime within `year_gap` years before `end`.
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    Draws from the `random.Random` instance `rng`, so it's reproducible.
+    """
 
-    return datetime.fromtimestamp(random_timestamp)
+    span = end - end.replace(year=end.year - year_gap)
+    return end - timedelta(seconds=rng.uniform(0, span.total_seconds()))
@@ -0,0 +1,55 @@
+"""gunicorn settings, read automatically when gunicorn starts here.
+
+Metrics are collected per worker process (see metrics.py). To report them
+across all workers, start gunicorn with PROMETHEUS_MULTIPROC_DIR set to an
+empty directory, which should be cleared between runs:
+
+    rm -rf /tmp/warbler-metrics && mkdir /tmp/warbler-metrics
+    PROMETHEUS_MULTIPROC_DIR=/tmp/warbler-metrics gunicorn "app:create_app('production')"
+
+Each worker also gets a slot that no other live worker has, which goes
+into the message ids it makes (see snowflake.py). There are 32 slots, so
+run at most 32 workers per MESSAGE_ID_NODE.
+
+Workers are threaded (gthread), GUNICORN_THREADS requests at a time each.
+A sync worker serves one request at a time, so at most one password hash
+would ever be in flight in it and the hasher's queue limit (see
+passwords.py) could never be reached. The default leaves a few threads
+over once PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE are hashing, to
+answer the next login with a 503 and keep serving other pages. Each thread
+may hold a database connection, so keep DB_POOL_SIZE + DB_MAX_OVERFLOW at
+or above GUNICORN_THREADS.
+"""
+
+import os
+
+from config import env_int
+from snowflake import SLOTS, message_ids
+
+worker_class = 'gthread'
+threads = env_int('GUNICORN_THREADS', env_int('PASSWORD_HASH_WORKERS', 4)
+                  + env_int('PASSWORD_HASH_QUEUE', 16) + 4)
+
+
+def pre_fork(server, worker):
+    """Give the worker about to start the lowest slot that's free."""
+
+    taken = {getattr(other, 'message_id_slot', None) for other in server.WORKERS.values()}
+    free = set(range(SLOTS)) - taken
+    if not free:
+        raise RuntimeError(f"All {SLOTS} message id slots are taken: run at most {SLOTS} "
+                           f"workers per MESSAGE_ID_NODE (see snowflake.py)")
+
+    worker.message_id_slot = min(free)
+
+
+def post_fork(server, worker):
+    message_ids.slot = worker.message_id_slot
+
+
+def child_exit(server, worker):
+    """Stop reporting a dead worker's live-only metrics."""
+
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
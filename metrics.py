@@ -0,0 +1,152 @@
+"""Prometheus metrics for requests, SQL, templates and password hashing.
+
+Every request is counted and timed per endpoint, along with how many SQL
+statements it ran and how long they took, and how long each template took
+to render. `passwords.py` times bcrypt. All of it is served at /metrics in
+Prometheus' text format.
+
+SQL timings are only summed up on `g` as statements run and recorded once
+per request, so the per-statement cost is a couple of clock reads. That
+keeps this cheap enough to leave on.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory before
+starting it (see gunicorn.conf.py): each worker then writes its metrics to
+files there and /metrics reports the totals across all workers, whichever
+worker answers the scrape.
+"""
+
+import os
+import time
+
+from flask import (Response, g, has_request_context, request, before_render_template,
+                   template_rendered)
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter,
+                               Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Requests that matched no route are counted under this endpoint, rather
+# than one label per URL a scanner tries.
+UNMATCHED = 'unmatched'
+
+REQUESTS = Counter(
+    'warbler_http_requests_total', "HTTP requests handled.",
+    ['endpoint', 'method', 'status'])
+
+REQUEST_SECONDS = Histogram(
+    'warbler_http_request_duration_seconds', "Time spent handling a request.",
+    ['endpoint'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+REQUEST_SQL_STATEMENTS = Histogram(
+    'warbler_http_request_sql_statements', "SQL statements run by one request.",
+    ['endpoint'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+
+SQL_STATEMENTS = Counter(
+    'warbler_sql_statements_total', "SQL statements run while handling requests.",
+    ['endpoint'])
+
+SQL_SECONDS = Counter(
+    'warbler_sql_duration_seconds_total', "Time spent in SQL while handling requests.",
+    ['endpoint'])
+
+TEMPLATE_SECONDS = Histogram(
+    'warbler_template_render_duration_seconds', "Time spent rendering a template.",
+    ['template'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+
+PASSWORD_HASH_SECONDS = Histogram(
+    'warbler_password_hash_duration_seconds', "Time spent in bcrypt, per hash or check.",
+    ['operation'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+
+
+def endpoint_label():
+    """The current request's endpoint, as a metric label."""
+
+    rule = request.url_rule
+    return rule.endpoint if rule is not None else UNMATCHED
+
+
+class Metrics:
+    """Record request, SQL and template metrics for an app."""
+
+    def init_app(self, app):
+        """Hook into `app`'s requests and templates, every SQLAlchemy
+        engine, and add the /metrics route."""
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+        before_render_template.connect(self.start_template, app)
+        template_rendered.connect(self.finish_template, app)
+
+        if not event.contains(Engine, 'before_cursor_execute', self.start_statement):
+            event.listen(Engine, 'before_cursor_execute', self.start_statement)
+            event.listen(Engine, 'after_cursor_execute', self.finish_statement)
+            event.listen(Engine, 'handle_error', self.failed_statement)
+
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+        g.template_starts = []
+
+    def finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            # A before_request hook ahead of ours returned early.
+            return response
+
+        endpoint = endpoint_label()
+
+        REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+        REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+        REQUEST_SQL_STATEMENTS.labels(endpoint).observe(g.sql_statements)
+        SQL_STATEMENTS.labels(endpoint).inc(g.sql_statements)
+        SQL_SECONDS.labels(endpoint).inc(g.sql_seconds)
+
+        return response
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_statement_starts', []).append(time.perf_counter())
+
+    def finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['metrics_statement_starts'].pop()
+
+        # SQL run outside a request (CLI commands, seeding) isn't counted.
+        if has_request_context() and 'sql_statements' in g:
+            g.sql_statements += 1
+            g.sql_seconds += elapsed
+
+    def failed_statement(self, context):
+        # after_cursor_execute won't run for this statement.
+        if context.connection is not None:
+            starts = context.connection.info.get('metrics_statement_starts')
+            if starts:
+                starts.pop()
+
+    def start_template(self, app, template, context):
+        if has_request_context() and 'template_starts' in g:
+            g.template_starts.append(time.perf_counter())
+
+    def finish_template(self, app, template, context):
+        if has_request_context() and g.get('template_starts'):
+            TEMPLATE_SECONDS.labels(template.name).observe(
+                time.perf_counter() - g.template_starts.pop())
+
+    def export(self):
+        """The /metrics route: every metric, in Prometheus' text format."""
+
+        registry = REGISTRY
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
@@ -1,12 +1,49 @@
 """SQLAlchemy models for Warbler."""
 
+import heapq
+import sys
+from collections import defaultdict
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.orm.attributes import set_committed_value
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hasher
+from replicas import RoutingSession
+from shards import message_shards, shard_tables
+from snowflake import message_ids
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def insert_if_absent(model, conflict_columns, **values):
+    """INSERT one row unless it would clash on `conflict_columns`.
+
+    A single INSERT ... ON CONFLICT DO NOTHING on Postgres and SQLite, so
+    concurrent inserts of the same row can't race. Returns True if the row
+    was inserted, False if it already existed.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = (insert(model)
+                .values(**values)
+                .on_conflict_do_nothing(index_elements=conflict_columns))
+        return db.session.execute(stmt).rowcount == 1
+
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(model).values(**values))
+    except IntegrityError:
+        return False
+
+    return True
 
 
 class Follows(db.Model):
@@ -14,6 +51,12 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key finds a user's followers; this finds who they follow.
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id_user_being_followed_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,28 +69,334 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def follow(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`.
+
+        Idempotent: following twice is a no-op. Returns True if a follow was
+        added, in which case counters and the follower's timeline are updated.
+        Raises ValueError if the two are the same user.
+        """
+
+        if follower_id == followed_id:
+            raise ValueError("Users can't follow themselves")
+
+        added = insert_if_absent(
+            cls, ['user_being_followed_id', 'user_following_id'],
+            user_being_followed_id=followed_id,
+            user_following_id=follower_id)
+
+        if added:
+            User.bump_counters(follower_id, following_count=1)
+            User.bump_counters(followed_id, followers_count=1)
+            TimelineEntry.add_author(follower_id, followed_id)
+
+        return added
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`.
+
+        Idempotent: returns True only if a follow was actually removed.
+        """
+
+        removed = db.session.execute(
+            db.delete(cls).where(cls.user_being_followed_id == followed_id,
+                                 cls.user_following_id == follower_id)
+        ).rowcount == 1
+
+        if removed:
+            User.bump_counters(follower_id, following_count=-1)
+            User.bump_counters(followed_id, followers_count=-1)
+            TimelineEntry.remove_author(follower_id, followed_id)
+
+        return removed
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
+    # The primary key finds a user's likes; this finds a message's likers.
+    __table_args__ = (
+        db.Index('ix_likes_message_id_user_id', 'message_id', 'user_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def like(cls, user_id, message_id):
+        """Have `user_id` like `message_id`.
+
+        Idempotent: returns True only if a like was actually added.
+        """
+
+        with message_shards.for_user(user_id):
+            added = insert_if_absent(cls, ['user_id', 'message_id'],
+                                     user_id=user_id, message_id=message_id)
+
+        if added:
+            User.bump_counters(user_id, likes_count=1)
+            Message.bump_like_counts({message_id: 1})
+
+        return added
+
+    @classmethod
+    def unlike(cls, user_id, message_id):
+        """Have `user_id` stop liking `message_id`.
+
+        Idempotent: returns True only if a like was actually removed.
+        """
+
+        with message_shards.for_user(user_id):
+            removed = db.session.execute(
+                db.delete(cls).where(cls.user_id == user_id,
+                                     cls.message_id == message_id)
+            ).rowcount == 1
+
+        if removed:
+            User.bump_counters(user_id, likes_count=-1)
+            Message.bump_like_counts({message_id: -1})
+
+        return removed
+
+
+    @classmethod
+    def messages_liked_by(cls, user_id):
+        """The messages `user_id` has liked, most recently liked first."""
+
+        if not message_shards.enabled:
+            return (Message
+                    .query
+                    .join(cls, cls.message_id == Message.id)
+                    .join(Message.user)
+                    .options(db.contains_eager(Message.user))
+                    .filter(cls.user_id == user_id)
+                    .order_by(cls.timestamp.desc())
+                    .all())
+
+        with message_shards.for_user(user_id):
+            liked_ids = db.session.scalars(
+                db.select(cls.message_id)
+                .where(cls.user_id == user_id)
+                .order_by(cls.timestamp.desc())).all()
+
+        messages = {msg.id: msg for msg in Message.gather(liked_ids)}
+        return [messages[message_id] for message_id in liked_ids if message_id in messages]
+
+
+class MessageAuthor(db.Model):
+    """Who wrote each message, when messages are sharded (see shards.py).
+
+    A message lives on its author's shard, so this is how it's found from
+    its id alone.
+    """
+
+    __tablename__ = 'message_authors'
+
     id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message fanned out to a user's home timeline.
+
+    Rows are written when a message is posted, so reading a home timeline
+    is a single range scan of the primary key instead of a join over
+    everyone the user follows. Message ids are in time order (see
+    snowflake.py), so (user_id, message_id) is also newest-first order.
+    """
+
+    __tablename__ = 'timelines'
+
+    # With shards, messages aren't in this database, so the foreign key to
+    # them is only created without (see shards.py).
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_author_id', 'user_id', 'author_id'),
+        db.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='cascade',
+                                name='timelines_message_id_fkey')
+        .ddl_if(callable_=lambda *args, **kwargs: not message_shards.enabled),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
     )
 
+    # How many of a user's most recent messages are copied into a
+    # timeline when somebody starts following them.
+    BACKFILL_LIMIT = 800
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's timeline and their followers'.
+
+        The message must already have its id.
+        """
+
+        followers = (db
+                     .select(Follows.user_following_id,
+                             db.literal(message.id, db.BigInteger),
+                             db.literal(message.user_id))
+                     .where(Follows.user_being_followed_id == message.user_id,
+                            # The author's own entry is added below; a stray
+                            # self-follow mustn't add it twice.
+                            Follows.user_following_id != message.user_id))
+
+        db.session.add(cls(user_id=message.user_id,
+                           message_id=message.id,
+                           author_id=message.user_id))
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id'],
+                followers))
+
+    @classmethod
+    def add_author(cls, user_id, author_id):
+        """Copy recent messages by `author_id` into `user_id`'s timeline."""
+
+        if user_id == author_id:
+            return
+
+        recent = (db
+                  .select(db.literal(user_id),
+                          Message.id,
+                          Message.user_id)
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.id.desc())
+                  .limit(cls.BACKFILL_LIMIT))
+
+        if message_shards.enabled:
+            # The author's messages are on a shard; copy them over by hand.
+            with message_shards.for_user(author_id):
+                rows = db.session.execute(recent).all()
+
+            if rows:
+                db.session.execute(
+                    db.insert(cls.__table__),
+                    [dict(user_id=user_id, message_id=message_id, author_id=author_id)
+                     for _, message_id, author_id in rows])
+            return
+
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id'],
+                recent))
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop messages by `author_id` from `user_id`'s timeline."""
+
+        if user_id == author_id:
+            return
+
+        db.session.execute(
+            db.delete(cls).where(cls.user_id == user_id,
+                                 cls.author_id == author_id))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Drop a message from every timeline it was fanned out to."""
+
+        db.session.execute(db.delete(cls).where(cls.message_id == message_id))
+
+    @classmethod
+    def remove_user(cls, user_id):
+        """Drop a user's own timeline and their messages from all others."""
+
+        db.session.execute(
+            db.delete(cls).where(db.or_(cls.user_id == user_id,
+                                        cls.author_id == user_id)))
+
+    @classmethod
+    def backfill(cls, batch_size=1000):
+        """Rebuild every timeline from the messages and follows tables."""
+
+        if message_shards.enabled:
+            cls._backfill_from_shards(batch_size)
+            return
+
+        own = db.select(Message.user_id,
+                        Message.id,
+                        Message.user_id)
+
+        followed = (db
+                    .select(Follows.user_following_id,
+                            Message.id,
+                            Message.user_id)
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id)
+                    .where(Follows.user_following_id != Follows.user_being_followed_id))
+
+        db.session.execute(db.delete(cls))
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id'],
+                db.union_all(own, followed)))
+
+    @classmethod
+    def _backfill_from_shards(cls, batch_size):
+        db.session.execute(db.delete(cls))
+
+        for shard in message_shards.shards():
+            with message_shards.on(shard):
+                batches = db.session.execute(
+                    db.select(Message.id, Message.user_id)
+                    .execution_options(yield_per=batch_size)).partitions()
+
+            for batch in batches:
+                followers = defaultdict(list)
+                for follower_id, author_id in db.session.execute(
+                        db.select(Follows.user_following_id, Follows.user_being_followed_id)
+                        .where(Follows.user_being_followed_id.in_({row.user_id for row in batch}),
+                               Follows.user_following_id != Follows.user_being_followed_id)):
+                    followers[author_id].append(follower_id)
+
+                db.session.execute(
+                    db.insert(cls.__table__),
+                    [dict(user_id=reader_id, message_id=message_id, author_id=author_id)
+                     for message_id, author_id in batch
+                     for reader_id in [author_id, *followers[author_id]]])
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +443,56 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Admins can see operational pages such as /admin/slow-queries.
+
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Bumped whenever the user edits their profile, so cached renderings
+    # keyed on it (message fragments, page ETags) stop matching.
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Denormalized counts for profile headers. They are kept up to date by
+    # the write paths in app.py; `reconcile_counters` recomputes them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,14 +520,264 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            db.exists().where(Follows.user_being_followed_id == self.id,
+                              Follows.user_following_id == other_user.id)
+        ).scalar()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            db.exists().where(Follows.user_being_followed_id == other_user.id,
+                              Follows.user_following_id == self.id)
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Answers for a whole page of users in one query; returns a set of ids.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id,
+                   Follows.user_being_followed_id.in_(user_ids))))
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Answers for a page of messages in one query; returns a set of ids.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        with message_shards.for_user(self.id):
+            return set(db.session.scalars(
+                db.select(Likes.message_id)
+                .where(Likes.user_id == self.id,
+                       Likes.message_id.in_(message_ids))))
+
+    @classmethod
+    def bump_counters(cls, user_id, **deltas):
+        """Atomically add to one user's counters.
+
+        e.g. `User.bump_counters(user.id, followers_count=1)`
+        """
+
+        values = {name: getattr(cls, name) + delta for name, delta in deltas.items()}
+        db.session.execute(db.update(cls).where(cls.id == user_id).values(values))
+        cls.mark_changed([user_id])
+
+    @staticmethod
+    def mark_changed(user_ids=None):
+        """Note that the counters or profile of `user_ids` (of anybody, if
+        None) change when this transaction commits, so copies cached
+        outside the database can be dropped then (see app.CurrentUser)."""
+
+        changed = db.session.info.setdefault('changed_user_ids', set())
+        changed.update([None] if user_ids is None else user_ids)
+
+    def release_counters(self):
+        """Decrement the counters of every user connected to this one.
+
+        Call this before deleting the user: the people they followed lose a
+        follower, their followers follow one fewer user, anybody who liked
+        their messages loses those likes, and the messages they liked lose
+        a like.
+        """
+
+        # Too many users to list: anybody's counters may have changed.
+        User.mark_changed()
+
+        followed = (db.select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == self.id))
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(followed))
+            .values(followers_count=User.followers_count - 1))
+
+        followers = (db.select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == self.id))
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(followers))
+            .values(following_count=User.following_count - 1))
+
+        if message_shards.enabled:
+            self._release_like_counters_on_shards()
+            return
+
+        liked = db.select(Likes.message_id).where(Likes.user_id == self.id)
+        db.session.execute(
+            db.update(Message)
+            .where(Message.id.in_(liked))
+            .values(like_count=Message.like_count - 1))
+
+        liked_here = (db.select(db.func.count())
+                      .select_from(Likes)
+                      .join(Message, Message.id == Likes.message_id)
+                      .where(Message.user_id == self.id,
+                             Likes.user_id == User.id)
+                      .scalar_subquery())
+        likers = (db.select(Likes.user_id)
+                  .join(Message, Message.id == Likes.message_id)
+                  .where(Message.user_id == self.id))
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(likers))
+            .values(likes_count=User.likes_count - liked_here))
+
+    def _release_like_counters_on_shards(self):
+        with message_shards.for_user(self.id):
+            own = db.session.scalars(
+                db.select(Message.id).where(Message.user_id == self.id)).all()
+            liked = db.session.scalars(
+                db.select(Likes.message_id).where(Likes.user_id == self.id)).all()
+
+        Message.bump_like_counts({message_id: -1 for message_id in liked})
+
+        if not own:
+            return
+
+        for shard in message_shards.shards():
+            with message_shards.on(shard):
+                liked_here = db.session.execute(
+                    db.select(Likes.user_id, db.func.count())
+                    .where(Likes.message_id.in_(own))
+                    .group_by(Likes.user_id)).all()
+
+            for user_id, count in liked_here:
+                User.bump_counters(user_id, likes_count=-count)
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        cls.mark_changed()
+
+        def count(table, column):
+            return (db.select(db.func.count())
+                    .select_from(table)
+                    .where(column == cls.id)
+                    .scalar_subquery())
+
+        if not message_shards.enabled:
+            db.session.execute(
+                db.update(cls).values(
+                    messages_count=count(Message, Message.user_id),
+                    following_count=count(Follows, Follows.user_following_id),
+                    followers_count=count(Follows, Follows.user_being_followed_id),
+                    likes_count=count(Likes, Likes.user_id),
+                ),
+                execution_options={'synchronize_session': False})
+            return
+
+        # Messages and likes are counted on each shard and added up here.
+        db.session.execute(
+            db.update(cls).values(
+                messages_count=0,
+                following_count=count(Follows, Follows.user_following_id),
+                followers_count=count(Follows, Follows.user_being_followed_id),
+                likes_count=0,
+            ),
+            execution_options={'synchronize_session': False})
+
+        users = cls.__table__
+        for model, counter in [(Message, 'messages_count'), (Likes, 'likes_count')]:
+            add_count = (db.update(users)
+                         .where(users.c.id == db.bindparam('counted_id'))
+                         .values({counter: users.c[counter] + db.bindparam('count')}))
+
+            for shard in message_shards.shards():
+                with message_shards.on(shard):
+                    counts = db.session.execute(
+                        db.select(model.user_id, db.func.count())
+                        .group_by(model.user_id)).all()
+
+                if counts:
+                    db.session.execute(add_count, [dict(counted_id=user_id, count=total)
+                                                   for user_id, total in counts])
+
+    @classmethod
+    def search(cls, query='', after=None, limit=24, substrings=True):
+        """Find users whose username contains `query`, ignoring case.
+
+        Usernames starting with `query` rank first, then (for queries of 3+
+        characters, if `substrings` is set) ones containing it elsewhere;
+        each group is in username order. The prefix group is a range scan on
+        the lower(username) index. The substring group uses a trigram index:
+        pg_trgm on Postgres, an FTS5 trigram table on SQLite. With an empty
+        query this lists everyone in username order.
+
+        `after` is the position to continue from, as returned by the
+        previous call. Returns (users, next_after); next_after is None on
+        the last page.
+        """
+
+        dialect = db.session.get_bind().dialect.name
+        key = db.func.lower(cls.username)
+        if dialect == 'postgresql':
+            key = key.collate('C')
+
+        query = query.lower()
+        is_prefix = db.true()
+        if query:
+            # The smallest string above every one starting with `query`: bump
+            # its last character that isn't already the highest code point.
+            stem = query.rstrip(chr(sys.maxunicode))
+            is_prefix = key >= query
+            if stem:
+                successor = stem[:-1] + chr(ord(stem[-1]) + 1)
+                is_prefix = db.and_(is_prefix, key < successor)
+
+        rank, after_key, after_id = after or (0, None, None)
+        rows = []
+
+        def fetch(rank, condition, count):
+            stmt = db.select(cls, key).where(condition)
+            if after_key is not None:
+                stmt = stmt.where(db.tuple_(key, cls.id) > db.tuple_(after_key, after_id))
+            stmt = stmt.order_by(key, cls.id).limit(count)
+            return [(rank, username_key, user)
+                    for user, username_key in db.session.execute(stmt)]
+
+        if rank == 0:
+            rows += fetch(0, is_prefix, limit + 1)
+            after_key = after_id = None
+
+        if len(rows) <= limit and substrings and len(query) >= 3:
+            escaped = (query.replace('\\', '\\\\')
+                            .replace('%', '\\%')
+                            .replace('_', '\\_'))
+            pattern = f"%{escaped}%"
+            # Uncollated, to match the trigram index's expression: LIKE
+            # can't use it under COLLATE "C".
+            contains = db.func.lower(cls.username).like(pattern, escape='\\')
+
+            if dialect == 'sqlite':
+                # Narrow to candidates from the trigram table first; the
+                # LIKE above then applies exact escaping to those few rows.
+                candidates = (db.select(db.literal_column('rowid'))
+                              .select_from(db.table('users_trigram'))
+                              .where(db.literal_column('username').like(f"%{query}%")))
+                contains = db.and_(cls.id.in_(candidates), contains)
+
+            rows += fetch(1, db.and_(contains, db.not_(is_prefix)),
+                          limit + 1 - len(rows))
+
+        if len(rows) <= limit:
+            return [user for _, _, user in rows], None
+
+        rows = rows[:limit]
+        rank, username_key, user = rows[-1]
+        return [user for _, _, user in rows], (rank, username_key, user.id)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +786,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -162,22 +811,78 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's password?
+
+        If the stored hash was made at a different bcrypt cost than we use
+        now, it is replaced with a fresh hash; the caller commits it.
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+
+# Username search indexes (see `User.search`). These use expressions and
+# extensions that differ between Postgres and SQLite, so they're created with
+# raw DDL alongside the users table rather than declared as `db.Index`es.
+
+for statement in [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+]:
+    event.listen(User.__table__, 'before_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in [
+    'CREATE INDEX ix_users_username_key ON users (lower(username) COLLATE "C", id)',
+    'CREATE INDEX ix_users_username_trgm ON users USING gin (lower(username) gin_trgm_ops)',
+]:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in [
+    'CREATE INDEX ix_users_username_key ON users (lower(username), id)',
+    "CREATE VIRTUAL TABLE users_trigram USING fts5(username, tokenize='trigram')",
+    'CREATE TRIGGER users_trigram_insert AFTER INSERT ON users BEGIN'
+    ' INSERT INTO users_trigram (rowid, username) VALUES (new.id, new.username); END',
+    'CREATE TRIGGER users_trigram_update AFTER UPDATE OF username ON users BEGIN'
+    ' UPDATE users_trigram SET username = new.username WHERE rowid = old.id; END',
+    'CREATE TRIGGER users_trigram_delete AFTER DELETE ON users BEGIN'
+    ' DELETE FROM users_trigram WHERE rowid = old.id; END',
+]:
+    event.listen(User.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(User.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS users_trigram').execute_if(dialect='sqlite'))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
+    # Made in process and in time order (see snowflake.py), so the newest
+    # messages have the largest ids.
+
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=message_ids.next_id,
     )
 
     text = db.Column(
@@ -188,7 +893,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +902,356 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # How many users like this message, kept up to date by Likes.like and
+    # Likes.unlike so listing messages doesn't need to count likes.
+
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def post(cls, user_id, text):
+        """Add a message by `user_id`, counted and fanned out to timelines.
+
+        With shards, it's also recorded in MessageAuthor.
+        """
+
+        msg = cls(id=message_ids.next_id(), user_id=user_id, text=text)
+
+        if message_shards.enabled:
+            db.session.execute(db.insert(MessageAuthor).values(id=msg.id, user_id=user_id))
+
+        db.session.add(msg)
+        db.session.flush()
+        User.bump_counters(user_id, messages_count=1)
+        TimelineEntry.fan_out(msg)
+
+        return msg
+
+    @classmethod
+    def find(cls, message_id):
+        """The message with `message_id`, its author loaded, or None."""
+
+        if not message_shards.enabled:
+            return db.session.get(cls, message_id, options=[db.joinedload(cls.user)])
+
+        author_id = db.session.scalar(
+            db.select(MessageAuthor.user_id).where(MessageAuthor.id == message_id))
+        if author_id is None:
+            return None
+
+        with message_shards.for_user(author_id):
+            msg = db.session.get(cls, message_id)
+
+        if msg is not None:
+            cls.load_authors([msg])
+
+        return msg
+
+    @classmethod
+    def gather(cls, message_ids, authors=None):
+        """The messages with `message_ids`, newest first, authors loaded.
+
+        With shards, each shard holding some of them is asked for its share
+        and the answers are merged by id. `authors` maps ids to
+        their authors' user ids, if the caller knows them already;
+        otherwise they're looked up in MessageAuthor.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return []
+
+        if not message_shards.enabled:
+            return (cls.query
+                    .options(db.joinedload(cls.user))
+                    .filter(cls.id.in_(message_ids))
+                    .order_by(cls.id.desc())
+                    .all())
+
+        if authors is None:
+            authors = cls.authors_of(message_ids)
+
+        by_shard = defaultdict(list)
+        for message_id in message_ids:
+            if message_id in authors:
+                by_shard[message_shards.shard_of(authors[message_id])].append(message_id)
+
+        pages = []
+        for shard, ids in by_shard.items():
+            with message_shards.on(shard):
+                pages.append(cls.query.filter(cls.id.in_(ids)).order_by(cls.id.desc()).all())
+
+        messages = list(heapq.merge(*pages, key=lambda msg: msg.id, reverse=True))
+        cls.load_authors(messages)
+
+        return messages
+
+    @classmethod
+    def authors_of(cls, message_ids):
+        """Map each of `message_ids` that exists to its author's user id,
+        from MessageAuthor. Only needed with shards."""
+
+        return dict(db.session.execute(
+            db.select(MessageAuthor.id, MessageAuthor.user_id)
+            .where(MessageAuthor.id.in_(message_ids))).all())
+
+    @classmethod
+    def bump_like_counts(cls, deltas):
+        """Atomically add to messages' like counts.
+
+        e.g. `Message.bump_like_counts({msg.id: 1})`
+        """
+
+        if not deltas:
+            return
+
+        if not message_shards.enabled:
+            for message_id, delta in deltas.items():
+                db.session.execute(db.update(cls)
+                                   .where(cls.id == message_id)
+                                   .values(like_count=cls.like_count + delta))
+            return
+
+        # Each message is on its author's shard.
+        for message_id, author_id in cls.authors_of(list(deltas)).items():
+            with message_shards.for_user(author_id):
+                db.session.execute(db.update(cls)
+                                   .where(cls.id == message_id)
+                                   .values(like_count=cls.like_count + deltas[message_id]))
+
+    @classmethod
+    def reconcile_like_counts(cls):
+        """Recompute every message's like count from the likes table."""
+
+        if not message_shards.enabled:
+            db.session.execute(
+                db.update(cls).values(
+                    like_count=(db.select(db.func.count())
+                                .select_from(Likes)
+                                .where(Likes.message_id == cls.id)
+                                .scalar_subquery())),
+                execution_options={'synchronize_session': False})
+            return
+
+        # A message's likes can be on any shard: count them on each and
+        # add them up on the message's own.
+        for shard in message_shards.shards():
+            with message_shards.on(shard):
+                db.session.execute(db.update(cls).values(like_count=0),
+                                   execution_options={'synchronize_session': False})
+
+        for shard in message_shards.shards():
+            with message_shards.on(shard):
+                counts = dict(db.session.execute(
+                    db.select(Likes.message_id, db.func.count())
+                    .group_by(Likes.message_id)).all())
+
+            cls.bump_like_counts(counts)
+
+    @classmethod
+    def load_authors(cls, messages):
+        """Set `user` on each of `messages` from one query of the primary.
+
+        For messages read from a shard, where the users table isn't.
+        """
+
+        user_ids = {msg.user_id for msg in messages}
+        if not user_ids:
+            return
+
+        users = {user.id: user
+                 for user in db.session.scalars(db.select(User).where(User.id.in_(user_ids)))}
+
+        for msg in messages:
+            set_committed_value(msg, 'user', users.get(msg.user_id))
+
+    def remove(self):
+        """Delete this message, its likes, and its timeline entries."""
+
+        TimelineEntry.remove_message(self.id)
+        self.release_likes()
+        User.bump_counters(self.user_id, messages_count=-1)
+        db.session.delete(self)
+
+        if message_shards.enabled:
+            db.session.execute(db.delete(MessageAuthor).where(MessageAuthor.id == self.id))
+
+    def release_likes(self):
+        """Remove this message's likes and decrement its likers' counters."""
+
+        if message_shards.enabled:
+            # Likes are on their likers' shards, which could be any of them.
+            for shard in message_shards.shards():
+                with message_shards.on(shard):
+                    likers = db.session.scalars(
+                        db.select(Likes.user_id).where(Likes.message_id == self.id)).all()
+                    db.session.execute(db.delete(Likes).where(Likes.message_id == self.id))
+
+                if likers:
+                    db.session.execute(
+                        db.update(User)
+                        .where(User.id.in_(likers))
+                        .values(likes_count=User.likes_count - 1))
+            return
+
+        likers = db.select(Likes.user_id).where(Likes.message_id == self.id)
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(likers))
+            .values(likes_count=User.likes_count - 1))
+        db.session.execute(db.delete(Likes).where(Likes.message_id == self.id))
+
+
+# Full-text search over message text (see search.py) on Postgres. The GIN
+# index is on the same expression the search query uses, so the config name
+# must match exactly.
+
+TEXT_SEARCH_CONFIG = db.literal_column("'english'::regconfig")
+
+# The messages and likes tables as created on each shard (see shards.py).
+
+shard_metadata = shard_tables(db.metadata)
+
+for table in [Message.__table__, shard_metadata.tables['messages']]:
+    event.listen(table, 'after_create',
+                 DDL("CREATE INDEX ix_messages_text_tsv ON messages "
+                     "USING gin (to_tsvector('english'::regconfig, text))")
+                 .execute_if(dialect='postgresql'))
+
+
+def create_missing_indexes():
+    """Create the indexes declared on the models that the database lacks.
+
+    `db.create_all()` only adds missing tables, so a database made before
+    an index was declared needs this. An index counts as present if there
+    is one on the same columns under any name, including one backing a
+    primary key or unique constraint. On Postgres, indexes are built
+    CONCURRENTLY so that writes to the table carry on meanwhile. Returns
+    the names of the indexes created.
+    """
+
+    engine = db.engine
+    inspector = db.inspect(engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        present = {tuple(index['column_names']) for index in inspector.get_indexes(table.name)}
+        present |= {tuple(constraint['column_names'])
+                    for constraint in inspector.get_unique_constraints(table.name)}
+        present.add(tuple(inspector.get_pk_constraint(table.name)['constrained_columns']))
+
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if tuple(column.name for column in index.columns) in present:
+                continue
+
+            statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if engine.dialect.name == 'postgresql':
+                statement = statement.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+
+            # CONCURRENTLY can't run inside a transaction.
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(db.text(statement))
+            created.append(index.name)
+
+    return created
+
+
+# Changes to tables that existed before, for `upgrade_schema`. Each can run
+# again on a database that already has it.
+
+UPGRADE_STATEMENTS = [
+    # Counters and the admin flag (users), and the profile version that
+    # cached pages are keyed on.
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS is_admin BOOLEAN NOT NULL DEFAULT false',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 1',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0',
+    'ALTER TABLE users ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0',
+
+    # Username and message text search.
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS ix_users_username_key ON users (lower(username) COLLATE "C", id)',
+    'CREATE INDEX IF NOT EXISTS ix_users_username_trgm ON users '
+    'USING gin (lower(username) gin_trgm_ops)',
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_tsv ON messages "
+    "USING gin (to_tsvector('english'::regconfig, text))",
+
+    # 64-bit message ids, made in process (see snowflake.py). Existing ids
+    # are all smaller than new ones, so they still sort in time order.
+    'ALTER TABLE messages ALTER COLUMN id TYPE BIGINT',
+    'ALTER TABLE messages ALTER COLUMN id DROP DEFAULT',
+    'DROP SEQUENCE IF EXISTS messages_id_seq',
+    'ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT',
+    'ALTER TABLE timelines ALTER COLUMN message_id TYPE BIGINT',
+    'ALTER TABLE message_authors ALTER COLUMN id TYPE BIGINT',
+
+    # Timelines are ordered by message id now, not timestamp (this drops
+    # ix_timelines_user_id_timestamp with it).
+    'ALTER TABLE timelines DROP COLUMN IF EXISTS "timestamp"',
+
+    # Like counts on messages.
+    'ALTER TABLE messages ADD COLUMN IF NOT EXISTS like_count INTEGER NOT NULL DEFAULT 0',
+
+    # Likes keyed on (user_id, message_id): any number of users can like a
+    # message, and the surrogate id goes.
+    'ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key',
+    'ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_user_id_message_id_key',
+    'DROP INDEX IF EXISTS ix_likes_user_id_message_id',
+    'ALTER TABLE likes ADD COLUMN IF NOT EXISTS "timestamp" TIMESTAMP NOT NULL DEFAULT now()',
+    'ALTER TABLE likes ALTER COLUMN "timestamp" DROP DEFAULT',
+    'DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL',
+]
+
+# Run only while likes still has its surrogate id.
+LIKES_PRIMARY_KEY_STATEMENTS = [
+    'ALTER TABLE likes DROP CONSTRAINT likes_pkey',
+    'ALTER TABLE likes DROP COLUMN id',
+    'ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)',
+]
+
+
+def upgrade_schema():
+    """Bring a Postgres database made by an earlier version up to date.
+
+    `db.create_all()` adds missing tables but never changes existing ones.
+    This creates any missing tables, applies UPGRADE_STATEMENTS in one
+    transaction, and then builds missing indexes (see
+    `create_missing_indexes`). Afterwards, recompute the counters it adds
+    and fill in timelines with `flask reconcile-counters` and `flask
+    backfill-timelines`.
+
+    SQLite has no ALTER COLUMN, so development databases are rebuilt
+    (`python seed.py`) instead; this raises RuntimeError on them.
+    """
+
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        raise RuntimeError(f"Can't upgrade a {engine.dialect.name} database in place; "
+                           f"rebuild it with `python seed.py`")
+
+    db.create_all()
+
+    with engine.begin() as conn:
+        for statement in UPGRADE_STATEMENTS:
+            conn.execute(db.text(statement))
+
+        if 'id' in {column['name'] for column in db.inspect(conn).get_columns('likes')}:
+            for statement in LIKES_PRIMARY_KEY_STATEMENTS:
+                conn.execute(db.text(statement))
+
+    return create_missing_indexes()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,79 @@
+"""Keyset pagination for message and user lists.
+
+Pages are addressed by an opaque cursor holding the sort key of the last row
+on the previous page -- e.g. the id of a message -- so fetching page 50 is the same index
+range read as fetching page 1 -- unlike OFFSET, which has to walk past every
+earlier row.
+"""
+
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+
+def encode_values(values):
+    """Encode a tuple of JSON-able sort-key values as an opaque cursor."""
+
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_values(cursor):
+    """Decode a cursor from `encode_values` back into a tuple.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        values = json.loads(raw)
+    except (TypeError, UnicodeDecodeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+    if not isinstance(values, list):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+    return tuple(values)
+
+
+def encode_cursor(id):
+    """Encode an id position as an opaque URL-safe string."""
+
+    return encode_values([id])
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from `encode_cursor`.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    try:
+        id, = decode_values(cursor)
+        return int(id)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+def paginate(query, id_col, cursor=None, per_page=20):
+    """Fetch one newest-first page of `query`, keyed on id.
+
+    Message ids are in time order (see snowflake.py), so `id_col` alone
+    orders the page; it should be covered by an index that starts with the
+    query's filter column.
+
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+
+    if cursor:
+        query = query.filter(id_col < decode_cursor(cursor))
+
+    items = (query
+             .order_by(id_col.desc())
+             .limit(per_page + 1)
+             .all())
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    return items, encode_cursor(items[-1].id)
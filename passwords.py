@@ -0,0 +1,119 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow (~250ms at cost 12), so hashes are computed on a
+small thread pool -- bcrypt releases the GIL while it works -- and the number
+of hashes in flight is capped. When the cap is hit we raise `HasherBusy`
+straight away instead of queueing more requests behind a login burst.
+
+The pool and the cap belong to one process. A request waits for its hash,
+so the cap only comes into play when a process serves requests on several
+threads at once: gunicorn.conf.py runs threaded workers for this. Across
+the server, up to (workers x cap) hashes can be in flight.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_bcrypt import Bcrypt
+
+from metrics import PASSWORD_HASH_SECONDS
+
+DEFAULT_ROUNDS = 12
+
+bcrypt = Bcrypt()
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already queued."""
+
+
+def hash_rounds(hashed):
+    """The bcrypt cost a hash was made with, e.g. 12 for "$2b$12$..."."""
+
+    return int(hashed.split('$')[2])
+
+
+def timed(operation, fn):
+    """Wrap `fn` to record its run time as a password hash `operation`.
+
+    Runs on the pool thread, so time spent queued isn't counted.
+    """
+
+    def run(*args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            PASSWORD_HASH_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+    return run
+
+
+class PasswordHasher:
+    """Hash and check passwords on a thread pool of `max_workers`.
+
+    At most `max_workers + max_queue` hashes may be in flight; past that,
+    `hash` and `check` raise `HasherBusy`.
+    """
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, max_workers=4, max_queue=16):
+        self.configure(rounds, max_workers, max_queue)
+
+    def configure(self, rounds, max_workers, max_queue):
+        """(Re)size the pool and set the work factor for new hashes."""
+
+        old_executor = getattr(self, '_executor', None)
+
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    def init_app(self, app):
+        """Configure from BCRYPT_LOG_ROUNDS, PASSWORD_HASH_WORKERS and
+        PASSWORD_HASH_QUEUE in `app.config`."""
+
+        self.configure(app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS),
+                       app.config.get('PASSWORD_HASH_WORKERS', 4),
+                       app.config.get('PASSWORD_HASH_QUEUE', 16))
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        hashed = self._run(timed('hash', bcrypt.generate_password_hash), password, self.rounds)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(timed('check', bcrypt.check_password_hash), hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than we use now?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+
+        def run_and_release():
+            try:
+                return fn(*args)
+            finally:
+                self._slots.release()
+
+        try:
+            future = self._executor.submit(run_and_release)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        return future.result()
+
+
+hasher = PasswordHasher()
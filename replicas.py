@@ -0,0 +1,117 @@
+"""Read replicas, with read-your-writes for the user who wrote.
+
+List replica URLs in the REPLICA_DATABASE_URLS config (the
+DATABASE_REPLICA_URLS environment variable, comma-separated) and views
+decorated with `@reads_from_replica` run their SELECTs against one of them,
+picked at random per request. Everything else -- other routes, writes, and
+any SQL that isn't a SELECT -- goes to the primary.
+
+A replica can lag behind the primary, so someone who just posted a message
+or followed a user would not see the change. Once a request writes, the
+rest of it reads from the primary, and so do that user's requests for the
+next REPLICA_STICKY_SECONDS (kept in their session cookie).
+
+Locally, point DATABASE_URL and DATABASE_REPLICA_URLS at two SQLite files
+(or two Postgres databases) and copy one to the other to "replicate".
+"""
+
+import random
+import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+from shards import message_shards
+
+# Session key: until when (a Unix time) this user reads from the primary.
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+def reads_from_replica(view):
+    """Let `view` read from a replica. Only for GET routes that don't need
+    the very latest data from other users."""
+
+    view.reads_from_replica = True
+    return view
+
+
+def note_write():
+    """The current request has written: read from the primary from now on."""
+
+    if has_request_context():
+        g.wrote_to_primary = True
+
+
+class RoutingSession(Session):
+    """A Flask-SQLAlchemy session that sends messages and likes to their
+    shard (see shards.py), other SELECTs to the request's replica if it has
+    one, and everything else to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        instance = kwargs.pop('instance', None)
+
+        if bind is None:
+            shard = message_shards.engine_for(mapper, instance)
+            if shard is not None:
+                return shard
+
+        if self._flushing or getattr(clause, 'is_dml', False):
+            note_write()
+
+        elif bind is None and getattr(clause, 'is_select', False) and has_request_context():
+            replica = g.get('replica_engine')
+            if replica is not None and not g.get('wrote_to_primary'):
+                return replica
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @property
+    def connection_callable(self):
+        # With shards, flushes pick a connection per row, so that each row
+        # goes to its own user's shard. Left unset otherwise, since it
+        # turns off the session's bulk operations.
+        return self._connection_for_row if message_shards.enabled else None
+
+    def _connection_for_row(self, mapper, instance):
+        return self.get_transaction().connection(mapper, instance=instance)
+
+
+class Replicas:
+    """Pick a replica for each request that can use one."""
+
+    def init_app(self, app):
+        """Make engines for `app`'s REPLICA_DATABASE_URLS.
+
+        They are kept in app.extensions['replicas'] rather than made
+        Flask-SQLAlchemy binds, which would give every model a second home.
+        """
+
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.extensions['replicas'] = [create_engine(url, **options)
+                                      for url in app.config.get('REPLICA_DATABASE_URLS', [])]
+
+        app.before_request(self.choose_replica)
+        app.after_request(self.stick_to_primary)
+
+    def choose_replica(self):
+        g.replica_engine = None
+        g.wrote_to_primary = False
+
+        replicas = current_app.extensions['replicas']
+        view = current_app.view_functions.get(request.endpoint)
+
+        if (replicas
+                and request.method in ('GET', 'HEAD')
+                and getattr(view, 'reads_from_replica', False)
+                and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()):
+            g.replica_engine = random.choice(replicas)
+
+    def stick_to_primary(self, response):
+        if g.get('wrote_to_primary') and current_app.extensions['replicas']:
+            session[PRIMARY_UNTIL_KEY] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+        return response
+
+
+replicas = Replicas()
@@ -0,0 +1,327 @@
+"""Full-text search over message text.
+
+On Postgres, messages are matched with to_tsvector/plainto_tsquery against a
+GIN expression index and ranked with ts_rank. Other databases (SQLite in
+development and tests) get an inverted index of message text held in process
+memory: it is built from the messages table on the first search and then
+kept up to date by the routes that add and delete messages. Like
+`cache.TTLCache`, it lives in one process, so with several gunicorn workers
+a message posted through another worker isn't found until this worker
+rebuilds its index, which it does on the first search after the index is
+MESSAGE_INDEX_TTL seconds old. That search builds a new index and swaps it
+in; searches arriving meanwhile use the old one rather than starting
+rebuilds of their own.
+
+Both backends match messages containing every word of the query, rank them,
+and page through the results with a (rank, id) cursor. Message ids are in
+time order (see snowflake.py), so ties in rank go to the newest message.
+"""
+
+import heapq
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from models import db, Message, TEXT_SEARCH_CONFIG
+from shards import message_shards
+
+# Too common to be worth indexing; Postgres' english config drops these too.
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i if in is it its of on
+    or so that the their there this to was we were will with you your
+""".split())
+
+WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercased words of `text`, minus stop words."""
+
+    return [word for word in WORD_RE.findall(text.lower()) if word not in STOP_WORDS]
+
+
+class InvertedIndex:
+    """Map each word to the messages containing it.
+
+    Postings hold the number of times the word appears in each message, so
+    a match's rank is how often the query's words occur in it.
+
+    `built` is True once the index has been filled and for `ttl` seconds
+    after (for ever if ttl is None), after which it needs a rebuild;
+    `filled` stays True, as the old contents are still good to search
+    while that happens.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._built_at = None
+        self._postings = {}
+        self._documents = {}
+        self._changes = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    @property
+    def built(self):
+        if self._built_at is None:
+            return False
+
+        return self.ttl is None or time.monotonic() - self._built_at < self.ttl
+
+    @property
+    def filled(self):
+        return self._built_at is not None
+
+    @property
+    def tracking(self):
+        """Should new messages be added? Not until there are contents for
+        them to join, or a rebuild that might have read its rows too soon."""
+
+        return self.filled or self._changes is not None
+
+    def add(self, id, text):
+        """Index message `id`, replacing any earlier version of it."""
+
+        with self._lock:
+            self._add(id, text)
+            if self._changes is not None:
+                self._changes.append((id, text))
+
+    def remove(self, id):
+        """Drop message `id` from the index, if present."""
+
+        with self._lock:
+            self._remove(id)
+            if self._changes is not None:
+                self._changes.append((id, None))
+
+    def clear(self):
+        """Drop everything and mark the index as needing a rebuild."""
+
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._built_at = None
+
+    @contextmanager
+    def rebuilding(self):
+        """Yield an empty index to fill, and swap its contents in on exit.
+
+        Until then searches see the current contents. Messages added or
+        removed in the meantime are applied to the replacement as well, so
+        it doesn't miss anything that happened after it read its rows.
+        """
+
+        with self._lock:
+            self._changes = []
+
+        try:
+            replacement = InvertedIndex()
+            yield replacement
+
+            with self._lock:
+                for id, text in self._changes:
+                    if text is None:
+                        replacement._remove(id)
+                    else:
+                        replacement._add(id, text)
+
+                self._postings = replacement._postings
+                self._documents = replacement._documents
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._changes = None
+
+    def search(self, words, after=None, limit=20):
+        """Best matches for `words` as (rank, id), best first.
+
+        A message matches if it contains every one of `words`. Results are
+        ordered by rank, then newest first; `after` is the (rank, id) of the
+        last result on the previous page.
+        """
+
+        with self._lock:
+            postings = [self._postings.get(word, {}) for word in set(words)]
+            if not postings:
+                return []
+
+            # Intersect starting from the rarest word so the candidate set
+            # is as small as it will get from the outset.
+            postings.sort(key=len)
+            rarest, *rest = postings
+            matches = ((count + sum(posting[id] for posting in rest), id)
+                       for id, count in rarest.items()
+                       if all(id in posting for posting in rest))
+
+            if after is not None:
+                after = tuple(after)
+                matches = (match for match in matches if match < after)
+
+            return heapq.nlargest(limit, matches)
+
+    def _add(self, id, text):
+        self._remove(id)
+
+        counts = Counter(tokenize(text))
+        for word, count in counts.items():
+            self._postings.setdefault(word, {})[id] = count
+
+        self._documents[id] = tuple(counts)
+
+    def _remove(self, id):
+        document = self._documents.pop(id, None)
+        if document is None:
+            return
+
+        for word in document:
+            posting = self._postings[word]
+            del posting[id]
+            if not posting:
+                del self._postings[word]
+
+
+message_index = InvertedIndex()
+
+# Held while `message_index` is rebuilt, so only one rebuild runs at a time.
+_rebuild_lock = threading.RLock()
+
+
+def uses_database_search():
+    """Can the database search message text itself?"""
+
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def build_message_index(batch_size=10_000):
+    """(Re)build `message_index` from every message in the database.
+
+    The new contents replace the old in one step once they're complete.
+    """
+
+    with _rebuild_lock, message_index.rebuilding() as replacement:
+        for shard in message_shards.shards():
+            with message_shards.on(shard):
+                rows = db.session.execute(
+                    db.select(Message.id, Message.text)
+                    .execution_options(yield_per=batch_size))
+
+            for id, text in rows:
+                replacement.add(id, text)
+
+
+def refresh_message_index():
+    """Rebuild `message_index` if it is missing or stale.
+
+    However many searches ask at once, one rebuilds. The others go on
+    searching the stale index, or wait for the rebuild if there's no index
+    to search yet.
+    """
+
+    if not _rebuild_lock.acquire(blocking=not message_index.filled):
+        return
+
+    try:
+        if not message_index.built:
+            build_message_index()
+    finally:
+        _rebuild_lock.release()
+
+
+def index_message(message):
+    """Make a newly committed `message` searchable."""
+
+    if not uses_database_search() and message_index.tracking:
+        message_index.add(message.id, message.text)
+
+
+def unindex_messages(message_ids):
+    """Stop returning the deleted `message_ids` from searches."""
+
+    if not uses_database_search():
+        for id in message_ids:
+            message_index.remove(id)
+
+
+def search_messages(query, after=None, limit=20):
+    """Find messages containing every word of `query`, best match first.
+
+    `after` is the position to continue from, as returned by the previous
+    call. Returns (messages, next_after); next_after is None on the last
+    page. Messages come with their authors loaded.
+    """
+
+    if uses_database_search():
+        rows = _database_search(query, after, limit + 1)
+    else:
+        rows = _index_search(query, after, limit + 1)
+
+    if len(rows) <= limit:
+        return [msg for _, msg in rows], None
+
+    rows = rows[:limit]
+    rank, msg = rows[-1]
+    return [msg for _, msg in rows], (rank, msg.id)
+
+
+def _database_search(query, after, count):
+    document = db.func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)
+    tsquery = db.func.plainto_tsquery(TEXT_SEARCH_CONFIG, query)
+    # ts_rank returns a float4, which doesn't survive the trip through a
+    # cursor as a Python float (a float8): compare and return it as float8.
+    rank = db.cast(db.func.ts_rank(document, tsquery), db.Float(53))
+
+    stmt = db.select(Message, rank).where(document.op('@@')(tsquery))
+
+    if after is not None:
+        stmt = stmt.where(db.tuple_(rank, Message.id) < db.tuple_(*after))
+
+    stmt = stmt.order_by(rank.desc(), Message.id.desc()).limit(count)
+
+    if not message_shards.enabled:
+        stmt = stmt.options(db.joinedload(Message.user))
+        return [(rank, msg) for msg, rank in db.session.execute(stmt)]
+
+    # Each shard ranks its own matches; the best `count` of them all win.
+    rows = []
+    for shard in message_shards.shards():
+        with message_shards.on(shard):
+            rows += [(rank, msg) for msg, rank in db.session.execute(stmt)]
+
+    rows = heapq.nlargest(count, rows, key=lambda row: (row[0], row[1].id))
+    Message.load_authors([msg for _, msg in rows])
+    return rows
+
+
+def _index_search(query, after, count):
+    if not message_index.built:
+        refresh_message_index()
+
+    matches = message_index.search(tokenize(query), after=after, limit=count)
+    if not matches:
+        return []
+
+    messages = {msg.id: msg for msg in Message.gather(id for _, id in matches)}
+
+    return [(rank, messages[id]) for rank, id in matches if id in messages]
+
+
+def encode_after(after):
+    """JSON-able form of a `search_messages` position, for a cursor."""
+
+    rank, id = after
+    return [rank, id]
+
+
+def decode_after(values):
+    """Inverse of `encode_after`; raises ValueError if malformed."""
+
+    try:
+        rank, id = values
+        return float(rank), int(id)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid search position: {values!r}") from exc
@@ -1,19 +1,263 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Streams generator/users.csv, messages.csv and follows.csv into the database
+a chunk at a time -- with COPY FROM STDIN on Postgres, executemany batches
+elsewhere -- so memory stays flat however large the files are. Secondary
+indexes and foreign keys on the loaded tables are dropped for the load and
+rebuilt afterwards, which is much faster than maintaining them row by row.
 
-db.drop_all()
-db.create_all()
+    python seed.py                    # drop and recreate all tables first
+    python seed.py --append           # add to the existing data
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Rows in the CSVs refer to users by their 1-based line number in users.csv.
+When appending, those ids are shifted past the existing users. Messages are
+numbered from their timestamps (see `number_messages`).
+"""
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+import argparse
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from sqlalchemy import text
 
-db.session.commit()
+from app import create_app
+from models import db, User, Message, Follows, TimelineEntry
+from snowflake import MAX_SEQUENCE, SEQUENCE_BITS, WORKER_BITS, id_at
+
+# (table, CSV file, columns holding user ids)
+TABLES = [
+    (User.__table__, 'users.csv', ['id']),
+    (Message.__table__, 'messages.csv', ['user_id']),
+    (Follows.__table__, 'follows.csv', ['user_being_followed_id', 'user_following_id']),
+]
+
+# Also rebuilt from scratch after the load, so its indexes are deferred too.
+DEFERRED_TABLES = [table.name for table, _, _ in TABLES] + [TimelineEntry.__tablename__]
+
+
+def chunks(rows, size):
+    """Split the iterable `rows` into lists of up to `size` rows."""
+
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def read_csv(f, user_columns, user_offset):
+    """Read the open CSV file `f`; return (columns, rows).
+
+    `rows` is an iterator, with the `user_columns` shifted by `user_offset`.
+    """
+
+    reader = csv.reader(f)
+    columns = next(reader)
+
+    # users.csv has no id column; a user's id is its line number.
+    numbered = 'id' in user_columns and 'id' not in columns
+    if numbered:
+        columns = ['id'] + columns
+
+    shifted = [columns.index(column) for column in user_columns]
+
+    def rows():
+        for line, row in enumerate(reader, start=1):
+            if numbered:
+                row = [line] + row
+            for index in shifted:
+                row[index] = int(row[index]) + user_offset
+            yield row
+
+    return columns, rows()
+
+
+def number_messages(columns, rows, first_line):
+    """Add an id column to messages.csv `rows`.
+
+    Ids are made from each message's timestamp, like those of messages
+    posted through the app (see snowflake.py), so they sort by time. The
+    row's line number, counted from `first_line`, fills the worker and
+    sequence bits to tell apart messages from the same millisecond.
+    """
+
+    at = columns.index('timestamp')
+
+    def numbered():
+        for line, row in enumerate(rows, start=first_line):
+            spread = line % (1 << (WORKER_BITS + SEQUENCE_BITS))
+            id = id_at(datetime.fromisoformat(row[at]),
+                       spread >> SEQUENCE_BITS, spread & MAX_SEQUENCE)
+            yield [id] + row
+
+    return ['id'] + columns, numbered()
+
+
+def load_table(table, path, user_columns, user_offset, chunk_size):
+    """Stream the CSV at `path` into `table`; return the number of rows."""
+
+    dialect = db.session.get_bind().dialect.name
+    count = 0
+
+    with open(path, newline='') as f:
+        columns, rows = read_csv(f, user_columns, user_offset)
+
+        if table is Message.__table__:
+            existing = db.session.scalar(db.select(db.func.count()).select_from(table))
+            columns, rows = number_messages(columns, rows, existing)
+
+        if dialect == 'postgresql':
+            cursor = db.session.connection().connection.cursor()
+            quoted = ', '.join(f'"{column}"' for column in columns)
+            copy = f"COPY {table.name} ({quoted}) FROM STDIN WITH (FORMAT csv)"
+
+            for chunk in chunks(rows, chunk_size):
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(chunk)
+                buffer.seek(0)
+                cursor.copy_expert(copy, buffer)
+                count += len(chunk)
+
+        else:
+            convert = [converter(table.c[column]) for column in columns]
+
+            for chunk in chunks(rows, chunk_size):
+                db.session.execute(
+                    table.insert(),
+                    [{column: fn(value) for column, fn, value in zip(columns, convert, row)}
+                     for row in chunk])
+                count += len(chunk)
+
+    return count
+
+
+def converter(column):
+    """Parse a CSV field for `column` (COPY does this itself on Postgres)."""
+
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, db.Integer):
+        return int
+    return str
+
+
+def defer_constraints(table_names):
+    """Drop the secondary indexes and foreign keys on `table_names`.
+
+    Returns the statements that recreate them.
+    """
+
+    dialect = db.session.get_bind().dialect.name
+    restore = []
+
+    if dialect == 'postgresql':
+        tables = {'tables': table_names}
+
+        for table, name, definition in db.session.execute(text(
+                "SELECT CAST(conrelid AS regclass), conname, pg_get_constraintdef(oid) "
+                "FROM pg_constraint "
+                "WHERE contype = 'f' AND conrelid = ANY(CAST(:tables AS regclass[]))"),
+                tables).all():
+            db.session.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+            restore.append(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}')
+
+        # Indexes backing a primary key or unique constraint stay, since
+        # they're what keeps the loaded data valid.
+        for name, definition in db.session.execute(text(
+                "SELECT CAST(indexrelid AS regclass), pg_get_indexdef(indexrelid) "
+                "FROM pg_index "
+                "WHERE indrelid = ANY(CAST(:tables AS regclass[])) "
+                "AND NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)"),
+                tables).all():
+            db.session.execute(text(f'DROP INDEX {name}'))
+            restore.insert(0, definition)
+
+    elif dialect == 'sqlite':
+        # Constraint indexes are automatic and have no SQL; those stay.
+        placeholders = ', '.join(f':t{i}' for i in range(len(table_names)))
+        for name, definition in db.session.execute(text(
+                "SELECT name, sql FROM sqlite_master "
+                f"WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({placeholders})"),
+                {f't{i}': name for i, name in enumerate(table_names)}).all():
+            db.session.execute(text(f'DROP INDEX "{name}"'))
+            restore.append(definition)
+
+    return restore
+
+
+def rebuild(restore):
+    """Run the statements from `defer_constraints`."""
+
+    for statement in restore:
+        db.session.execute(text(statement))
+
+
+def reset_sequences():
+    """Move Postgres id sequences past ids we inserted explicitly."""
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text(
+            "SELECT setval(pg_get_serial_sequence('users', 'id'), "
+            "COALESCE(MAX(id), 0) + 1, false) FROM users"))
+
+
+def report(label, count, seconds):
+    rate = count / seconds if seconds else float('inf')
+    print(f"{label:<12} {count:>12,} rows in {seconds:8.1f}s ({rate:,.0f} rows/sec)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dir', default='generator',
+                        help="directory holding the CSV files")
+    parser.add_argument('--append', action='store_true',
+                        help="keep existing data instead of recreating the tables")
+    parser.add_argument('--chunk-size', type=int, default=10_000)
+    args = parser.parse_args()
+
+    if not args.append:
+        db.drop_all()
+        db.create_all()
+
+    user_offset = db.session.scalar(db.select(db.func.coalesce(db.func.max(User.id), 0)))
+
+    restore = defer_constraints(DEFERRED_TABLES)
+
+    try:
+        for table, filename, user_columns in TABLES:
+            start = time.perf_counter()
+            count = load_table(table, os.path.join(args.dir, filename),
+                               user_columns, user_offset, args.chunk_size)
+            report(table.name, count, time.perf_counter() - start)
+
+        reset_sequences()
+
+        start = time.perf_counter()
+        TimelineEntry.backfill()
+        report('timelines', db.session.scalar(db.select(db.func.count()).select_from(TimelineEntry)),
+               time.perf_counter() - start)
+
+    except Exception:
+        db.session.rollback()
+
+        # Postgres rolls the dropped indexes back with everything else, but
+        # SQLite has already committed the DROP INDEXes.
+        if db.session.get_bind().dialect.name == 'sqlite':
+            rebuild(restore)
+            db.session.commit()
+        raise
+
+    start = time.perf_counter()
+    rebuild(restore)
+    print(f"Rebuilt {len(restore)} indexes and foreign keys in "
+          f"{time.perf_counter() - start:.1f}s")
+
+    User.reconcile_counters()
+
+    db.session.commit()
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        main()
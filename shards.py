@@ -0,0 +1,241 @@
+"""Horizontal sharding of messages and likes by user id.
+
+List database URLs in the MESSAGE_SHARD_URLS config (the
+DATABASE_SHARD_URLS environment variable, comma-separated) and the messages
+and likes tables live in those databases instead of the primary: a user's
+messages are on shard `user_id % N`, and so are the likes they've given.
+Users, follows, timelines and the message_authors directory (see
+`models.MessageAuthor`) stay on the primary.
+
+Code that queries Message or Likes picks a shard first:
+
+    with message_shards.for_user(user_id):
+        messages = Message.query.filter_by(user_id=user_id).all()
+
+    for shard in message_shards.shards():
+        with message_shards.on(shard):
+            ...
+
+and the session sends those queries to it. Flushes need no help: each new,
+changed or deleted row goes to the shard of its own user_id. A query on
+either table with no shard picked raises `ShardNotChosen` rather than
+quietly reading the primary's (empty) tables.
+
+Without shard URLs, `shards()` is just [None], `on` and `for_user` do
+nothing and everything runs on the primary as before.
+
+Shards hold copies of the primary's tables minus foreign keys, which can't
+point across databases; for the same reason, the primary's timelines are
+created without their foreign key to messages when sharding is on. `flask rebalance-shards` creates them and moves
+rows to the shard they belong on -- from the primary when sharding is first
+turned on, and between shards after their number changes. A shard commits
+separately from the primary, so a failure between the two can leave one
+without the other's half of a write; `flask reconcile-counters` and
+`flask backfill-timelines` repair the primary's side.
+"""
+
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import (Column, Index, MetaData, Table, UniqueConstraint, create_engine, delete,
+                        insert, inspect, select, text, true, tuple_)
+
+# The sharded tables. Each is keyed on its user_id column.
+SHARDED_TABLES = ('messages', 'likes')
+
+
+class ShardNotChosen(RuntimeError):
+    """A query on a sharded table ran without a shard picked for it."""
+
+
+def shard_tables(metadata):
+    """Copies of the sharded tables in `metadata`, without foreign keys, on
+    a MetaData of their own."""
+
+    shard_metadata = MetaData()
+
+    for name in SHARDED_TABLES:
+        table = metadata.tables[name]
+
+        columns = [Column(column.name, column.type, primary_key=column.primary_key,
+                          nullable=column.nullable, autoincrement=column.autoincrement,
+                          server_default=column.server_default and column.server_default.arg)
+                   for column in table.columns]
+        unique = [UniqueConstraint(*[column.name for column in constraint.columns])
+                  for constraint in table.constraints
+                  if isinstance(constraint, UniqueConstraint)]
+
+        copy = Table(name, shard_metadata, *columns, *unique)
+
+        for index in table.indexes:
+            Index(index.name, *[copy.c[column.name] for column in index.columns],
+                  unique=index.unique)
+
+    return shard_metadata
+
+
+class MessageShards:
+    """The shard databases, and which one the current code is using."""
+
+    def init_app(self, app):
+        """Make engines for `app`'s MESSAGE_SHARD_URLS.
+
+        Like replicas, they are kept in app.extensions['message_shards']
+        rather than made Flask-SQLAlchemy binds, which map a model to one
+        database rather than to one of several.
+        """
+
+        options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.extensions['message_shards'] = [create_engine(url, **options)
+                                            for url in app.config.get('MESSAGE_SHARD_URLS', [])]
+
+    @property
+    def engines(self):
+        if not has_app_context():
+            return []
+
+        return current_app.extensions.get('message_shards', [])
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def shard_of(self, user_id):
+        """The shard holding `user_id`'s messages and likes."""
+
+        return user_id % len(self.engines)
+
+    def shards(self):
+        """Every shard, to visit one at a time with `on`; [None] if unsharded."""
+
+        return list(range(len(self.engines))) or [None]
+
+    @contextmanager
+    def on(self, shard):
+        """Send queries on the sharded tables to `shard` (a number from
+        `shards()`) for the duration of the block."""
+
+        previous = g.get('message_shard')
+        g.message_shard = shard
+        try:
+            yield
+        finally:
+            g.message_shard = previous
+
+    def for_user(self, user_id):
+        """Send queries on the sharded tables to `user_id`'s shard."""
+
+        return self.on(self.shard_of(user_id) if self.enabled else None)
+
+    def engine_for(self, mapper, instance=None):
+        """The engine that a statement on `mapper` (or a flush of
+        `instance`) should use, or None if it's not for a shard."""
+
+        if mapper is None or not self.enabled:
+            return None
+
+        table = inspect(mapper).local_table.name
+        if table not in SHARDED_TABLES:
+            return None
+
+        if instance is not None:
+            return self.engines[self.shard_of(instance.user_id)]
+
+        shard = g.get('message_shard')
+        if shard is None:
+            raise ShardNotChosen(f"Pick a shard before querying {table} "
+                                 f"(see message_shards.for_user / message_shards.on)")
+
+        return self.engines[shard]
+
+    def rebalance(self, primary, metadata, shard_metadata, batch_size=1000):
+        """Move every message and like to the shard it belongs on.
+
+        `primary` is the primary's engine, `metadata` its tables and
+        `shard_metadata` the shards' (see `shard_tables`). Creates the
+        shards' tables if need be, then moves rows left on the primary from
+        before sharding was turned on, then rows on the wrong shard since
+        the number of shards changed. Rows are copied before they're
+        deleted and copies that already exist are skipped, so it's safe to
+        run again after an interruption. Returns how many rows moved.
+        """
+
+        engines = self.engines
+        for engine in engines:
+            shard_metadata.create_all(engine)
+
+        if primary.dialect.name == 'postgresql':
+            # Timelines now point at messages on other databases. (The
+            # constraint would also cascade the moves below into deletes.)
+            with primary.begin() as conn:
+                conn.execute(text('ALTER TABLE timelines DROP CONSTRAINT IF EXISTS '
+                                  'timelines_message_id_fkey'))
+
+        sources = [(primary, metadata, lambda table: true())]
+        sources += [(engine, shard_metadata,
+                     lambda table, shard=shard: table.c.user_id % len(engines) != shard)
+                    for shard, engine in enumerate(engines)]
+
+        moved = 0
+
+        for source, tables, misplaced in sources:
+            # Likes first: on the primary, deleting a message cascades to them.
+            for name in reversed(SHARDED_TABLES):
+                table = tables.tables[name]
+                key = table.primary_key.columns
+
+                while True:
+                    with source.connect() as conn:
+                        rows = conn.execute(select(table)
+                                            .where(misplaced(table))
+                                            .order_by(*key)
+                                            .limit(batch_size)).all()
+                    if not rows:
+                        break
+
+                    by_shard = {}
+                    for row in rows:
+                        by_shard.setdefault(self.shard_of(row.user_id), []).append(row)
+                    for shard, shard_rows in by_shard.items():
+                        with engines[shard].begin() as conn:
+                            _copy_rows(conn, shard_metadata.tables[name], shard_rows)
+
+                    if source is primary and name == 'messages':
+                        with primary.begin() as conn:
+                            _copy_rows(conn, metadata.tables['message_authors'],
+                                       [dict(id=row.id, user_id=row.user_id) for row in rows])
+
+                    with source.begin() as conn:
+                        conn.execute(delete(table).where(_keys_in(table, rows)))
+
+                    moved += len(rows)
+
+        return moved
+
+
+message_shards = MessageShards()
+
+
+def _key_of(table, row):
+    values = getattr(row, '_mapping', row)
+    return tuple(values[column.name] for column in table.primary_key.columns)
+
+
+def _keys_in(table, rows):
+    """A WHERE clause matching `rows` by `table`'s primary key."""
+
+    return tuple_(*table.primary_key.columns).in_([_key_of(table, row) for row in rows])
+
+
+def _copy_rows(conn, table, rows):
+    """Insert `rows` into `table`, skipping any whose primary key it
+    already has."""
+
+    rows = [dict(row._mapping) if hasattr(row, '_mapping') else row for row in rows]
+
+    existing = set(conn.execute(select(*table.primary_key.columns)
+                                .where(_keys_in(table, rows))).all())
+    rows = [row for row in rows if _key_of(table, row) not in existing]
+
+    if rows:
+        conn.execute(insert(table), rows)
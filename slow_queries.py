@@ -0,0 +1,220 @@
+"""Opt-in log of slow SQL statements, with their query plans.
+
+Set SLOW_QUERY_THRESHOLD_MS and every statement that takes longer is
+logged (to the "slow_queries" logger) with the route that ran it, the shape
+of its parameters -- names and types, never values -- and how long it took.
+
+Statements are grouped by fingerprint: the SQL with whitespace collapsed
+and IN-lists of any length folded to "IN (...)", so the homepage's
+`IN (?, ?, ...)` lookups are one entry however many ids they carried. The
+first time a fingerprint is slow its plan is captured with EXPLAIN (which
+doesn't run the statement), and /admin/slow-queries shows the aggregates
+for this process.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import endpoint_label
+
+logger = logging.getLogger('slow_queries')
+
+# Past this many fingerprints, slow statements are still logged but new
+# fingerprints aren't aggregated.
+MAX_FINGERPRINTS = 500
+
+EXPLAINABLE = re.compile(r'\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# Bind parameter styles: qmark (SQLite) and pyformat (psycopg2).
+PLACEHOLDER = r'(?:\?|%\(\w+\)s|%s)'
+IN_LIST = re.compile(rf'\bIN\s*\(\s*{PLACEHOLDER}(?:\s*,\s*{PLACEHOLDER})*\s*\)', re.IGNORECASE)
+
+
+def normalize(statement):
+    """`statement` with its whitespace and IN-lists made uniform."""
+
+    statement = ' '.join(statement.split())
+    return IN_LIST.sub('IN (...)', statement)
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def parameters_shape(parameters, executemany):
+    """Describe `parameters` by name and type only, e.g. "{user_id: int}"."""
+
+    if executemany:
+        rows = list(parameters)
+        return f"{len(rows)} x {parameters_shape(rows[0], False)}" if rows else "0 rows"
+
+    if isinstance(parameters, dict):
+        # psycopg2 names IN-list members user_id_1_1, user_id_1_2, ...;
+        # count them rather than list them.
+        names = {}
+        for name, value in parameters.items():
+            base = re.sub(r'(_\d+)+$', '', name)
+            names.setdefault((base, type(value).__name__), []).append(name)
+        return "{" + ", ".join(f"{base}: {kind}" + (f" x{len(found)}" if len(found) > 1 else "")
+                               for (base, kind), found in names.items()) + "}"
+
+    kinds = [type(value).__name__ for value in parameters or ()]
+    if len(set(kinds)) == 1 and len(kinds) > 1:
+        return f"({kinds[0]} x{len(kinds)})"
+    return "(" + ", ".join(kinds) + ")"
+
+
+def explain(conn, statement, parameters):
+    """The plan for `statement`, as text, without running it.
+
+    Runs on the DBAPI connection directly, so it doesn't go through
+    SQLAlchemy's events (and get timed itself).
+    """
+
+    dialect = conn.dialect.name
+    dbapi_connection = conn.connection.dbapi_connection
+    cursor = dbapi_connection.cursor()
+
+    try:
+        if dialect == 'postgresql':
+            # A failed statement would abort the caller's transaction.
+            cursor.execute("SAVEPOINT slow_query_explain")
+            try:
+                cursor.execute(f"EXPLAIN (ANALYZE off) {statement}", parameters)
+                plan = "\n".join(row[0] for row in cursor.fetchall())
+            except Exception:
+                cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+                raise
+            finally:
+                cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+
+        elif dialect == 'sqlite':
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            plan = "\n".join(row[-1] for row in cursor.fetchall())
+
+        else:
+            cursor.execute(f"EXPLAIN {statement}", parameters)
+            plan = "\n".join(" ".join(str(column) for column in row)
+                             for row in cursor.fetchall())
+
+    finally:
+        cursor.close()
+
+    return plan
+
+
+class SlowQueryLog:
+    """Time statements on every engine and keep aggregates of slow ones.
+
+    `threshold` is in milliseconds; None turns the log off. Aggregates live
+    in one process, so with several gunicorn workers each has its own.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read SLOW_QUERY_THRESHOLD_MS from `app.config` and start timing."""
+
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD_MS')
+
+        if not event.contains(Engine, 'before_cursor_execute', self.start_statement):
+            event.listen(Engine, 'before_cursor_execute', self.start_statement)
+            event.listen(Engine, 'after_cursor_execute', self.finish_statement)
+            event.listen(Engine, 'handle_error', self.failed_statement)
+
+    def start_statement(self, conn, cursor, statement, parameters, context, executemany):
+        if self.threshold is not None:
+            conn.info.setdefault('slow_query_starts', []).append(time.perf_counter())
+
+    def finish_statement(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('slow_query_starts')
+        if not starts:
+            # The log was switched on mid-statement.
+            return
+
+        elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+        if self.threshold is None or elapsed_ms < self.threshold:
+            return
+
+        self.record(conn, statement, parameters, executemany, elapsed_ms)
+
+    def failed_statement(self, context):
+        if context.connection is not None:
+            starts = context.connection.info.get('slow_query_starts')
+            if starts:
+                starts.pop()
+
+    def record(self, conn, statement, parameters, executemany, elapsed_ms):
+        """Log one slow statement and add it to the aggregates."""
+
+        normalized = normalize(statement)
+        key = fingerprint(normalized)
+        route = endpoint_label() if has_request_context() else None
+        shape = parameters_shape(parameters, executemany)
+
+        logger.warning("Slow query %s (%.1fms) in %s: %s %s",
+                       key, elapsed_ms, route or "no request", normalized, shape)
+
+        with self._lock:
+            entry = self._queries.get(key)
+            if entry is None:
+                if len(self._queries) >= MAX_FINGERPRINTS:
+                    return
+                entry = self._queries[key] = {
+                    'fingerprint': key,
+                    'statement': normalized,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'routes': {},
+                    'plan': None,
+                }
+                explain_now = not executemany and EXPLAINABLE.match(statement)
+            else:
+                explain_now = False
+
+            entry['count'] += 1
+            entry['total_ms'] += elapsed_ms
+            entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+            entry['routes'][route] = entry['routes'].get(route, 0) + 1
+            entry['parameters'] = shape
+            entry['last_seen'] = datetime.utcnow()
+
+        if explain_now:
+            try:
+                plan = explain(conn, statement, parameters)
+            except Exception as error:
+                plan = f"EXPLAIN failed: {error}"
+            entry['plan'] = plan
+
+    def queries(self):
+        """The aggregates, slowest in total first."""
+
+        with self._lock:
+            entries = [dict(entry, routes=dict(entry['routes']))
+                       for entry in self._queries.values()]
+
+        for entry in entries:
+            entry['mean_ms'] = entry['total_ms'] / entry['count']
+
+        return sorted(entries, key=lambda entry: entry['total_ms'], reverse=True)
+
+    def clear(self):
+        """Forget every aggregate."""
+
+        with self._lock:
+            self._queries.clear()
+
+
+slow_query_log = SlowQueryLog()
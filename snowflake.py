@@ -0,0 +1,116 @@
+"""Time-ordered 64-bit message ids, made in process.
+
+An id packs three numbers into a positive 64-bit integer:
+
+    | 41 bits: milliseconds since EPOCH | 10 bits: worker | 12 bits: sequence |
+
+The time comes first, so sorting by id sorts by when a message was posted
+-- ORDER BY id DESC is newest first, and an id alone is a complete cursor.
+The worker number keeps two processes from ever making the same id, and
+the sequence counts the ids a process makes within one millisecond.
+
+A worker number is MESSAGE_ID_NODE (0-31, one per machine or container)
+times 32, plus a slot (0-31) for the process on that machine. Under
+gunicorn, gunicorn.conf.py gives each worker a slot no other live worker
+has. Any other process uses MESSAGE_ID_SLOT if it's set, and otherwise its
+pid mod 32 -- which two processes on one machine can share, so that fallback
+is only safe when a single process posts messages at a time (a dev server,
+a one-off script). Give every other process that posts alongside gunicorn
+its own MESSAGE_ID_SLOT, outside the range gunicorn hands out.
+
+Ids from one process only ever increase, even if the clock steps back;
+across processes they're in order to within the machines' clock skew.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+# Ids count milliseconds from here; 41 bits of them last until 2079.
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+SLOT_BITS = 5
+
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+SLOTS = 1 << SLOT_BITS
+NODES = 1 << (WORKER_BITS - SLOT_BITS)
+
+
+def make_id(millis, worker, sequence):
+    """The id for `sequence` made by `worker` at `millis` after EPOCH."""
+
+    return (millis << (WORKER_BITS + SEQUENCE_BITS)) | (worker << SEQUENCE_BITS) | sequence
+
+
+def id_at(when, worker=0, sequence=0):
+    """An id for the naive UTC datetime `when`, e.g. to number old rows."""
+
+    if when < EPOCH:
+        raise ValueError(f"Can't make an id for {when}, before {EPOCH}")
+
+    millis = int((when - EPOCH).total_seconds() * 1000)
+    return make_id(millis, worker, sequence)
+
+
+def time_of(id):
+    """The naive UTC datetime at which `id` was made, to the millisecond."""
+
+    return datetime.utcfromtimestamp((EPOCH_MS + (id >> (WORKER_BITS + SEQUENCE_BITS))) / 1000)
+
+
+class IdGenerator:
+    """Hands out increasing ids for this process; safe to share between threads."""
+
+    def __init__(self):
+        self.node = 0
+        self.slot = None
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def init_app(self, app):
+        self.node = app.config['MESSAGE_ID_NODE']
+        if not 0 <= self.node < NODES:
+            raise ValueError(f"MESSAGE_ID_NODE must be between 0 and {NODES - 1}")
+
+        slot = app.config.get('MESSAGE_ID_SLOT')
+        if slot is not None and not 0 <= slot < SLOTS:
+            raise ValueError(f"MESSAGE_ID_SLOT must be between 0 and {SLOTS - 1}")
+
+        # A slot from gunicorn's post_fork takes precedence.
+        if self.slot is None:
+            self.slot = slot
+
+    @property
+    def worker(self):
+        # Read on every call, not cached, so a forked child whose pid
+        # differs from its parent's stops sharing the parent's numbers.
+        slot = self.slot if self.slot is not None else os.getpid() % SLOTS
+        return self.node * SLOTS + slot
+
+    def next_id(self):
+        """The next id."""
+
+        now = int(time.time() * 1000) - EPOCH_MS
+
+        with self._lock:
+            if now > self._last_ms:
+                self._sequence = 0
+                self._last_ms = now
+            elif self._sequence < MAX_SEQUENCE:
+                # Same millisecond, or the clock stepped back: keep counting
+                # from the last one rather than go back in time.
+                self._sequence += 1
+            else:
+                # 4096 ids in one millisecond: borrow the next one.
+                self._sequence = 0
+                self._last_ms += 1
+
+            return make_id(self._last_ms, self.worker, self._sequence)
+
+
+message_ids = IdGenerator()
@@ -0,0 +1,118 @@
+"use strict";
+
+// Infinite scroll for message lists.
+//
+// A paginated list renders as <ul id="messages" data-page-url data-next-cursor>
+// followed by an "Older messages" link. When that link scrolls into view we
+// fetch the next page as an HTML fragment, append it, and move the cursor on.
+
+const $messages = document.getElementById("messages");
+const $more = document.getElementById("messages-more");
+
+let loadingMessages = false;
+let messagesObserver = null;
+
+async function loadMoreMessages() {
+  const cursor = $messages.dataset.nextCursor;
+  if (loadingMessages || !cursor) return;
+
+  loadingMessages = true;
+  try {
+    const resp = await axios.get($messages.dataset.pageUrl, { params: { cursor } });
+    $messages.insertAdjacentHTML("beforeend", resp.data.html);
+    $messages.dataset.nextCursor = resp.data.next_cursor || "";
+    if (!resp.data.next_cursor) $more.remove();
+  } finally {
+    loadingMessages = false;
+  }
+
+  // Re-observing fires the callback again if the link is still on screen,
+  // so short pages keep loading until the viewport is filled.
+  if ($messages.dataset.nextCursor) {
+    messagesObserver.unobserve($more);
+    messagesObserver.observe($more);
+  }
+}
+
+if ($messages && $more && $messages.dataset.pageUrl && "IntersectionObserver" in window) {
+  messagesObserver = new IntersectionObserver(entries => {
+    if (entries.some(entry => entry.isIntersecting)) loadMoreMessages();
+  });
+  messagesObserver.observe($more);
+}
+
+
+// Likes and follows.
+//
+// Like and follow forms carry data-like-url / data-follow-url pointing at the
+// JSON API plus their current state. We call the API in place of the form
+// post, so clicking doesn't reload the page, and flip the button to match.
+
+async function toggleLike($form) {
+  const liked = $form.dataset.liked === "true";
+  const resp = await axios({ method: liked ? "delete" : "post", url: $form.dataset.likeUrl });
+
+  $form.dataset.liked = String(resp.data.liked);
+
+  const $icon = $form.querySelector("i");
+  $icon.className = resp.data.liked ? "fa-solid fa-heart" : "fa-regular fa-heart";
+  $icon.style.color = resp.data.liked ? "#ff0000" : "";
+
+  const $count = $form.querySelector(".like-count");
+  if ($count && resp.data.liked !== liked) {
+    $count.textContent = Number($count.textContent) + (resp.data.liked ? 1 : -1);
+  }
+}
+
+async function toggleFollow($form) {
+  const following = $form.dataset.following === "true";
+  const resp = await axios({ method: following ? "delete" : "post", url: $form.dataset.followUrl });
+
+  $form.dataset.following = String(resp.data.following);
+
+  const $button = $form.querySelector("button");
+  $button.textContent = resp.data.following ? "Unfollow" : "Follow";
+  $button.classList.toggle("btn-primary", resp.data.following);
+  $button.classList.toggle("btn-outline-primary", !resp.data.following);
+}
+
+document.addEventListener("submit", evt => {
+  const $form = evt.target;
+
+  if ($form.dataset.likeUrl) {
+    evt.preventDefault();
+    toggleLike($form);
+  } else if ($form.dataset.followUrl) {
+    evt.preventDefault();
+    toggleFollow($form);
+  }
+});
+
+
+// Username typeahead for the nav search box.
+
+const $search = document.getElementById("search");
+const $suggestions = document.getElementById("search-suggestions");
+
+let typeaheadTimer = null;
+
+async function suggestUsers() {
+  const q = $search.value.trim();
+  if (!q) return;
+
+  const resp = await axios.get($search.dataset.typeaheadUrl, { params: { q } });
+  if ($search.value.trim() !== q) return;   // a newer keystroke superseded us
+
+  $suggestions.replaceChildren(...resp.data.users.map(user => {
+    const $option = document.createElement("option");
+    $option.value = user.username;
+    return $option;
+  }));
+}
+
+if ($search && $suggestions) {
+  $search.addEventListener("input", () => {
+    clearTimeout(typeaheadTimer);
+    typeaheadTimer = setTimeout(suggestUsers, 150);
+  });
+}
@@ -0,0 +1,80 @@
+"""Static asset build tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from testing import app
+from assets import assets, build_assets
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinted static assets."""
+
+    def setUp(self):
+        """Build the assets from a scratch copy of static/."""
+
+        self.static_folder = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(app.static_folder, self.static_folder,
+                        ignore=shutil.ignore_patterns('build'))
+
+        self.original_static_folder = app.static_folder
+        app.static_folder = self.static_folder
+
+        self.manifest = build_assets(self.static_folder)
+        assets.load(self.static_folder)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Go back to the real static folder."""
+
+        app.static_folder = self.original_static_folder
+        assets.load(app.static_folder)
+        shutil.rmtree(os.path.dirname(self.static_folder))
+
+    def test_build_hashes_and_compresses(self):
+        """Assets get content-hashed names and compressed copies."""
+
+        entry = self.manifest['stylesheets/style.css']
+        self.assertRegex(entry['path'], r'^build/stylesheets/style\.[0-9a-f]{12}\.css$')
+        self.assertIn('gzip', entry['encodings'])
+        self.assertTrue(os.path.exists(os.path.join(self.static_folder, entry['path'] + '.gz')))
+
+        #Check that the stylesheet points at the hashed images
+        with open(os.path.join(self.static_folder, entry['path'])) as f:
+            css = f.read()
+        self.assertIn(self.manifest['images/nav-bg.png']['path'], css)
+        self.assertNotIn('/static/images/nav-bg.png', css)
+
+    def test_pages_link_hashed_assets(self):
+        """Templates' url_for('static', ...) resolves to the hashed names."""
+
+        html = self.client.get('/login').get_data(as_text=True)
+        self.assertIn(f"/static/{self.manifest['warbler.js']['path']}", html)
+        self.assertNotIn('/static/warbler.js"', html)
+
+    def test_hashed_assets_are_immutable_and_precompressed(self):
+        """Hashed files are cached for a year and sent precompressed."""
+
+        path = self.manifest['warbler.js']['path']
+        res = self.client.get(f"/static/{path}", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('javascript', res.mimetype)
+        self.assertIn('immutable', res.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', res.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+        #Check that the plain name is still served, but revalidated
+        res = self.client.get("/static/warbler.js")
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('immutable', res.headers['Cache-Control'])
+        res.close()
@@ -0,0 +1,99 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+from app import current_user_cache, message_fragment_cache
+from testing import app
+
+db.create_all()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(TestCase):
+    """Test per-request metrics and the /metrics endpoint."""
+
+    def setUp(self):
+        """Create test client and a user to look at."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+        current_user_cache.clear()
+        message_fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        user = User.signup(username="metricsuser", email="metrics@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_request_metrics(self):
+        """A request is counted and timed, with its SQL and templates."""
+
+        requests = sample('warbler_http_requests_total',
+                          endpoint='warbler.users_show', method='GET', status='200')
+        timed = sample('warbler_http_request_duration_seconds_count',
+                       endpoint='warbler.users_show')
+        statements = sample('warbler_sql_statements_total', endpoint='warbler.users_show')
+        rendered = sample('warbler_template_render_duration_seconds_count',
+                          template='users/show.html')
+
+        resp = self.client.get(f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+        #Check that the request, its SQL and its template were all recorded
+        self.assertEqual(sample('warbler_http_requests_total',
+                                endpoint='warbler.users_show', method='GET', status='200'),
+                         requests + 1)
+        self.assertEqual(sample('warbler_http_request_duration_seconds_count',
+                                endpoint='warbler.users_show'), timed + 1)
+        self.assertGreater(sample('warbler_sql_statements_total', endpoint='warbler.users_show'),
+                           statements)
+        self.assertEqual(sample('warbler_template_render_duration_seconds_count',
+                                template='users/show.html'), rendered + 1)
+
+    def test_unmatched_urls_share_a_label(self):
+        """404s for unknown URLs don't each get their own label."""
+
+        before = sample('warbler_http_requests_total',
+                        endpoint='unmatched', method='GET', status='404')
+
+        self.client.get("/no/such/page")
+        self.client.get("/another/missing/page")
+
+        self.assertEqual(sample('warbler_http_requests_total',
+                                endpoint='unmatched', method='GET', status='404'),
+                         before + 2)
+
+    def test_metrics_endpoint(self):
+        """/metrics serves everything in Prometheus' text format."""
+
+        self.client.get(f"/users/{self.user_id}")
+        resp = self.client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("text/plain", resp.content_type)
+
+        #Check that request, SQL, template and bcrypt metrics are all there
+        text = resp.get_data(as_text=True)
+        self.assertIn('warbler_http_requests_total{endpoint="warbler.users_show"', text)
+        self.assertIn('warbler_sql_duration_seconds_total{endpoint="warbler.users_show"}', text)
+        self.assertIn('warbler_template_render_duration_seconds_bucket', text)
+        self.assertIn('warbler_password_hash_duration_seconds_count{operation="hash"}', text)
@@ -0,0 +1,162 @@
+"""Query plan tests: the busiest pages use indexes, not full table scans."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+from app import CURR_USER_KEY, current_user_cache, message_fragment_cache
+from snowflake import message_ids
+from testing import app, QueryPlanMixin
+
+db.create_all()
+
+USERS = 500
+MESSAGES_PER_USER = 10
+FOLLOWS_PER_USER = 10
+
+LARGE_TABLES = ('users', 'messages', 'likes', 'follows', 'timelines')
+
+
+class QueryPlanTestCase(QueryPlanMixin, TestCase):
+    """Test the plans of the queries behind the main pages."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Seed enough rows that scanning a table costs more than searching
+        an index, and let the planner know it."""
+
+        clear_tables()
+
+        db.session.execute(db.insert(User.__table__), [
+            dict(id=n, username=f"user{n}", email=f"user{n}@test.com", password="password")
+            for n in range(1, USERS + 1)])
+
+        messages = [dict(id=message_ids.next_id(), user_id=n, text=f"warble {i} by {n}",
+                         timestamp=datetime(2024, 1, 1))
+                    for i in range(MESSAGES_PER_USER) for n in range(1, USERS + 1)]
+        db.session.execute(db.insert(Message.__table__), messages)
+
+        # Everybody follows the next few users along, and likes the
+        # messages of the user just after them.
+        db.session.execute(db.insert(Follows.__table__), [
+            dict(user_following_id=n, user_being_followed_id=(n + step - 1) % USERS + 1)
+            for n in range(1, USERS + 1) for step in range(1, FOLLOWS_PER_USER + 1)])
+        db.session.execute(db.insert(Likes.__table__), [
+            dict(user_id=(message['user_id'] - 2) % USERS + 1, message_id=message['id'])
+            for message in messages])
+
+        TimelineEntry.backfill()
+        db.session.commit()
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        clear_tables()
+
+    def setUp(self):
+        """Log in as a user in the middle of the pack."""
+
+        current_user_cache.clear()
+        message_fragment_cache.clear()
+
+        self.user_id = USERS // 2
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def get(self, url):
+        """GET `url`, checking that no query behind it scans a large table."""
+
+        with self.assertNoFullScans(*LARGE_TABLES) as queries:
+            resp = self.client.get(url)
+
+        #Check that the page rendered, and ran queries to check
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(queries.statements)
+        return resp
+
+    def test_homepage(self):
+        """The home timeline reads the user's timeline entries by key."""
+
+        resp = self.get("/")
+        self.assertIn("warble", resp.get_data(as_text=True))
+
+    def test_users_show(self):
+        """A profile reads the user's newest messages by index."""
+
+        resp = self.get(f"/users/{self.user_id + 1}")
+        self.assertIn(f"by {self.user_id + 1}", resp.get_data(as_text=True))
+
+    def test_show_likes(self):
+        """The likes page finds the user's likes by index."""
+
+        resp = self.get(f"/users/{self.user_id}/likes")
+        self.assertIn(f"by {self.user_id + 1}", resp.get_data(as_text=True))
+
+    def test_users_followers(self):
+        """The followers page looks up follows by the followed user."""
+
+        resp = self.get(f"/users/{self.user_id}/followers")
+        self.assertIn(f"@user{self.user_id - 1}", resp.get_data(as_text=True))
+
+    def test_show_following(self):
+        """The following page looks up follows by the follower."""
+
+        resp = self.get(f"/users/{self.user_id}/following")
+        self.assertIn(f"@user{self.user_id + 1}", resp.get_data(as_text=True))
+
+    def test_users_search(self):
+        """Username search finds prefixes and substrings by index."""
+
+        #Check that a prefix finds its user
+        resp = self.get("/users?q=user112")
+        self.assertIn("@user112<", resp.get_data(as_text=True))
+
+        #Check that a substring from the middle does too
+        resp = self.get("/users?q=r112")
+        self.assertIn("@user112<", resp.get_data(as_text=True))
+
+    def test_create_indexes(self):
+        """create-indexes adds declared indexes an older database lacks."""
+
+        name = 'ix_follows_user_following_id_user_being_followed_id'
+        db.session.execute(db.text(f"DROP INDEX {name}"))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["create-indexes"])
+
+        #Check that only the missing index was created
+        self.assertEqual(result.output.strip(), f"Created 1 indexes: {name}")
+        self.assertIn(name, [index['name'] for index in db.inspect(db.engine).get_indexes('follows')])
+
+        #Check that running it again does nothing
+        result = app.test_cli_runner().invoke(args=["create-indexes"])
+        self.assertEqual(result.output.strip(), "Created 0 indexes.")
+
+    def test_upgrade_schema(self):
+        """upgrade-schema runs on Postgres and points SQLite at a rebuild."""
+
+        result = app.test_cli_runner().invoke(args=["upgrade-schema"])
+
+        if db.engine.dialect.name == 'postgresql':
+            #Check that the upgrade ran and left the current schema alone
+            self.assertIn("Upgraded the schema and created 0 indexes", result.output)
+        else:
+            #Check that SQLite is told to rebuild instead
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn("python seed.py", result.output)
+
+
+def clear_tables():
+    for model in [TimelineEntry, Likes, Follows, Message, User]:
+        db.session.execute(db.delete(model.__table__))
+    db.session.commit()
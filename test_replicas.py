@@ -0,0 +1,94 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+from app import create_app, CURR_USER_KEY, current_user_cache, message_fragment_cache
+from config import TestingConfig
+from replicas import PRIMARY_UNTIL_KEY
+
+REPLICA_DIR = tempfile.mkdtemp()
+
+
+class ReplicaConfig(TestingConfig):
+    # An empty SQLite database stands in for a replica that hasn't caught
+    # up, so reads that reach it can't find the primary's rows.
+    REPLICA_DATABASE_URLS = [f"sqlite:///{os.path.join(REPLICA_DIR, 'replica.db')}"]
+
+
+replica_app = create_app(ReplicaConfig)
+
+with replica_app.app_context():
+    db.create_all()
+
+
+class ReplicaTestCase(TestCase):
+    """Test which database each request reads from."""
+
+    def setUp(self):
+        """Empty both databases, then add users to the primary only."""
+
+        self.context = replica_app.app_context()
+        self.context.push()
+
+        replica, = replica_app.extensions['replicas']
+        db.metadata.drop_all(replica)
+        db.metadata.create_all(replica)
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+        current_user_cache.clear()
+        message_fragment_cache.clear()
+
+        self.client = replica_app.test_client()
+
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+        self.reader_id, self.author_id = reader.id, author.id
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def test_reads_go_to_replica(self):
+        """Read-only routes read from the replica; others from the primary."""
+
+        #Check that the profile page misses the row only the primary has
+        self.assertEqual(self.client.get(f"/users/{self.author_id}").status_code, 404)
+
+        #Check that a route not marked for replicas still finds it
+        resp = self.client.post("/login", data={"username": "author", "password": "password"})
+        self.assertEqual(resp.status_code, 302)
+
+    def test_writer_sticks_to_primary(self):
+        """After writing, a user reads from the primary for a while."""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            client.post(f"/users/follow/{self.author_id}")
+
+            #Check that the follow pinned this user to the primary
+            self.assertEqual(client.get(f"/users/{self.author_id}").status_code, 200)
+
+            with client.session_transaction() as sess:
+                self.assertGreater(sess[PRIMARY_UNTIL_KEY], time.time())
+                sess[PRIMARY_UNTIL_KEY] = time.time() - 1
+
+            #Check that reads go back to the replica once the window is over
+            self.assertEqual(client.get(f"/users/{self.author_id}").status_code, 404)
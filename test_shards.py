@@ -0,0 +1,183 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy.schema import CreateTable
+
+from models import (db, User, Message, Likes, Follows, TimelineEntry, MessageAuthor,
+                    shard_metadata)
+from app import create_app, CURR_USER_KEY, current_user_cache, message_fragment_cache
+from config import TestingConfig
+from search import message_index
+from shards import message_shards
+
+SHARD_DIR = tempfile.mkdtemp()
+
+
+class ShardConfig(TestingConfig):
+    MESSAGE_SHARD_URLS = [f"sqlite:///{os.path.join(SHARD_DIR, f'shard{n}.db')}"
+                          for n in range(2)]
+
+
+shard_app = create_app(ShardConfig)
+
+with shard_app.app_context():
+    db.create_all()
+
+
+class ShardTestCase(TestCase):
+    """Test where messages and likes are kept, and reading them back."""
+
+    def setUp(self):
+        """Empty the primary and both shards, then add two users who land
+        on different shards."""
+
+        self.context = shard_app.app_context()
+        self.context.push()
+
+        for engine in message_shards.engines:
+            shard_metadata.drop_all(engine)
+            shard_metadata.create_all(engine)
+
+        for model in [User, Message, Likes, Follows, TimelineEntry, MessageAuthor]:
+            db.session.execute(db.delete(model.__table__))
+        db.session.commit()
+        current_user_cache.clear()
+        message_fragment_cache.clear()
+        message_index.clear()
+
+        self.client = shard_app.test_client()
+
+        reader = User.signup(username="reader", email="reader@test.com",
+                             password="password", image_url=None)
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+        self.reader_id, self.author_id = reader.id, author.id
+
+        Follows.follow(self.reader_id, self.author_id)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def rows_on(self, shard, table):
+        with message_shards.engines[shard].connect() as conn:
+            return conn.execute(db.select(shard_metadata.tables[table])).all()
+
+    def post(self, user_id, text):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_messages_on_authors_shard(self):
+        """Messages are stored on their author's shard and read back from it."""
+
+        self.post(self.author_id, "author's warble")
+        self.post(self.reader_id, "reader's warble")
+
+        author_shard = message_shards.shard_of(self.author_id)
+        reader_shard = message_shards.shard_of(self.reader_id)
+
+        #Check that the two users' messages went to different shards
+        self.assertNotEqual(author_shard, reader_shard)
+        self.assertEqual([row.text for row in self.rows_on(author_shard, 'messages')],
+                         ["author's warble"])
+        self.assertEqual([row.text for row in self.rows_on(reader_shard, 'messages')],
+                         ["reader's warble"])
+
+        #Check that the profile page reads them from the right shard
+        resp = self.client.get(f"/users/{self.author_id}")
+        self.assertIn("author&#39;s warble", resp.get_data(as_text=True))
+        self.assertNotIn("reader&#39;s warble", resp.get_data(as_text=True))
+
+        #Check that the homepage gathers both shards, newest first
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertLess(html.index("reader&#39;s warble"), html.index("author&#39;s warble"))
+
+    def test_likes_on_likers_shard(self):
+        """Likes are stored on the liker's shard and can be listed and undone."""
+
+        self.post(self.author_id, "likeable")
+        message_id = db.session.scalar(db.select(MessageAuthor.id))
+
+        self.post(self.reader_id, "unrelated")
+        resp = self.client.post(f"/api/messages/{message_id}/like")
+        self.assertEqual(resp.json, {"liked": True})
+
+        #Check that the like is on the reader's shard, not the author's
+        reader_shard = message_shards.shard_of(self.reader_id)
+        self.assertEqual([row.message_id for row in self.rows_on(reader_shard, 'likes')],
+                         [message_id])
+        self.assertEqual(db.session.get(User, self.reader_id).likes_count, 1)
+
+        #Check that the count on the message, on the author's shard, went up
+        author_shard = message_shards.shard_of(self.author_id)
+        self.assertEqual([row.like_count for row in self.rows_on(author_shard, 'messages')], [1])
+
+        #Check that the likes page finds the message on the author's shard
+        resp = self.client.get(f"/users/{self.reader_id}/likes")
+        self.assertIn("likeable", resp.get_data(as_text=True))
+
+        #Check that deleting the message removes the like on the other shard
+        self.client.post(f"/messages/{message_id}/delete")
+        self.assertEqual(self.rows_on(reader_shard, 'likes'), [])
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, self.reader_id).likes_count, 0)
+
+    def test_timelines_created_without_message_fk(self):
+        """A fresh sharded database's timelines don't point at messages,
+        which live on the shards."""
+
+        ddl = str(CreateTable(TimelineEntry.__table__).compile(dialect=db.engine.dialect))
+
+        #Check that only the users foreign keys are created
+        self.assertNotIn("REFERENCES messages", ddl)
+        self.assertIn("REFERENCES users", ddl)
+
+    def test_rebalance(self):
+        """rebalance-shards moves rows off the primary and between shards."""
+
+        messages = Message.__table__
+        db.session.execute(db.insert(messages), [
+            dict(id=1, user_id=self.author_id, text="old warble", timestamp=datetime(2024, 1, 1)),
+            dict(id=2, user_id=self.reader_id, text="another", timestamp=datetime(2024, 1, 1)),
+        ])
+        db.session.execute(db.insert(Likes.__table__),
+                           [dict(user_id=self.reader_id, message_id=1)])
+        db.session.commit()
+
+        runner = shard_app.test_cli_runner()
+        result = runner.invoke(args=["rebalance-shards"])
+
+        #Check that every row moved off the primary, to its user's shard
+        self.assertIn("Moved 3 rows", result.output)
+        self.assertEqual(db.session.scalar(db.select(db.func.count()).select_from(messages)), 0)
+        author_shard = message_shards.shard_of(self.author_id)
+        reader_shard = message_shards.shard_of(self.reader_id)
+        self.assertEqual([row.id for row in self.rows_on(author_shard, 'messages')], [1])
+        self.assertEqual([row.id for row in self.rows_on(reader_shard, 'messages')], [2])
+        self.assertEqual([row.message_id for row in self.rows_on(reader_shard, 'likes')], [1])
+
+        #Check that the moved messages can be found by id
+        self.assertEqual(Message.find(1).text, "old warble")
+
+        #Check that a row on the wrong shard is moved to the right one
+        with message_shards.engines[reader_shard].begin() as conn:
+            conn.execute(db.insert(shard_metadata.tables['messages']),
+                         dict(id=3, user_id=self.author_id, text="misplaced",
+                              timestamp=datetime(2024, 1, 1)))
+
+        result = runner.invoke(args=["rebalance-shards"])
+        self.assertIn("Moved 1 rows", result.output)
+        self.assertEqual([row.id for row in self.rows_on(author_shard, 'messages')], [1, 3])
@@ -0,0 +1,99 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+from app import CURR_USER_KEY, current_user_cache, message_fragment_cache
+from testing import app
+from slow_queries import slow_query_log, normalize, parameters_shape
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test slow statement aggregation and the admin page."""
+
+    def setUp(self):
+        """Create test client and users; log every statement as slow."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+        current_user_cache.clear()
+        message_fragment_cache.clear()
+
+        self.client = app.test_client()
+
+        admin = User.signup(username="admin", email="admin@test.com",
+                            password="password", image_url=None)
+        admin.is_admin = True
+        user = User.signup(username="regular", email="regular@test.com",
+                           password="password", image_url=None)
+        db.session.commit()
+        self.admin_id, self.user_id = admin.id, user.id
+
+        self.threshold = slow_query_log.threshold
+        slow_query_log.threshold = 0
+        slow_query_log.clear()
+
+    def tearDown(self):
+        slow_query_log.threshold = self.threshold
+        slow_query_log.clear()
+        db.session.rollback()
+
+    def test_fingerprints_fold_in_lists(self):
+        """IN-lists of any length share a fingerprint."""
+
+        self.assertEqual(normalize("SELECT *\n  FROM users WHERE id IN (?, ?, ?)"),
+                         "SELECT * FROM users WHERE id IN (...)")
+        self.assertEqual(normalize("SELECT * FROM users WHERE id IN (%(id_1_1)s, %(id_1_2)s)"),
+                         "SELECT * FROM users WHERE id IN (...)")
+
+        #Check that parameters are described by type, never by value
+        self.assertEqual(parameters_shape({'id_1_1': 5, 'id_1_2': 6, 'name': 'x'}, False),
+                         "{id: int x2, name: str}")
+        self.assertEqual(parameters_shape((5, 6, 7), False), "(int x3)")
+
+    def test_records_route_and_plan(self):
+        """Slow statements are grouped with their route and query plan."""
+
+        self.client.get(f"/users/{self.user_id}")
+
+        queries = slow_query_log.queries()
+        profile = [query for query in queries if 'warbler.users_show' in query['routes']]
+        self.assertTrue(profile)
+
+        #Check that a SELECT had its plan captured once
+        select = next(query for query in profile if query['statement'].startswith('SELECT'))
+        self.assertTrue(select['plan'])
+        self.assertNotIn("EXPLAIN failed", select['plan'])
+
+    def test_admin_page(self):
+        """Only admins can see the slow-query page."""
+
+        self.client.get(f"/users/{self.user_id}")
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = client.get("/admin/slow-queries")
+
+            #Check that a regular user is turned away
+            self.assertEqual(resp.status_code, 302)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = client.get("/admin/slow-queries")
+
+            #Check that an admin sees the aggregates
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warbler.users_show", resp.get_data(as_text=True))
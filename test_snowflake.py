@@ -0,0 +1,75 @@
+"""Message id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from snowflake import IdGenerator, MAX_SEQUENCE, SLOTS, id_at, time_of
+
+
+class IdGeneratorTestCase(TestCase):
+    """Test making time-ordered ids."""
+
+    def test_ids_increase(self):
+        """Ids only go up, even many to a millisecond."""
+
+        ids = IdGenerator()
+        made = [ids.next_id() for _ in range(3 * (MAX_SEQUENCE + 1))]
+
+        #Check that every id is larger than the one before
+        self.assertTrue(all(a < b for a, b in zip(made, made[1:])))
+
+    def test_ids_hold_their_time(self):
+        """An id records when it was made."""
+
+        before = datetime.utcnow() - timedelta(milliseconds=1)
+        made = time_of(IdGenerator().next_id())
+
+        #Check that the time is now, to the millisecond
+        self.assertLessEqual(before, made)
+        self.assertLessEqual(made, datetime.utcnow())
+
+        #Check that ids made from times sort like the times
+        self.assertLess(id_at(datetime(2024, 5, 1), worker=1023, sequence=MAX_SEQUENCE),
+                        id_at(datetime(2024, 5, 1, 0, 0, 0, 1000)))
+
+    def test_workers_differ(self):
+        """Processes in different slots never make the same id."""
+
+        first, second = IdGenerator(), IdGenerator()
+        first.slot, second.slot = 0, 1
+
+        #Check that ids made side by side never collide
+        made = []
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            made += [first.next_id(), second.next_id()]
+
+        self.assertEqual(len(set(made)), len(made))
+
+    def test_slot_from_config(self):
+        """MESSAGE_ID_SLOT sets the slot, unless gunicorn already has."""
+
+        class App:
+            config = {'MESSAGE_ID_NODE': 1, 'MESSAGE_ID_SLOT': 7}
+
+        ids = IdGenerator()
+        ids.init_app(App)
+        #Check that the worker number combines the node and the slot
+        self.assertEqual(ids.worker, 1 * SLOTS + 7)
+
+        ids = IdGenerator()
+        ids.slot = 3
+        ids.init_app(App)
+        #Check that a slot given by gunicorn is kept
+        self.assertEqual(ids.worker, 1 * SLOTS + 3)
+
+        App.config = {'MESSAGE_ID_NODE': 0, 'MESSAGE_ID_SLOT': SLOTS}
+        #Check that an out-of-range slot is refused
+        with self.assertRaises(ValueError):
+            IdGenerator().init_app(App)
@@ -0,0 +1,103 @@
+"""Helpers for the test suite."""
+
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from app import create_app
+from models import db
+from slow_queries import explain
+
+# The app every test module runs against. Its context stays pushed, so
+# tests can use the database outside of requests.
+app = create_app('testing')
+app.app_context().push()
+
+
+class QueryCounter:
+    """Record every SQL statement run on the app's engine while active.
+
+        with QueryCounter() as queries:
+            client.get("/")
+        print(len(queries.statements))
+
+    `executions` pairs each statement with the parameters it ran with.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.statements = []
+        self.executions = []
+
+    def __enter__(self):
+        self.engine = self.engine or db.engine
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def __len__(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+        self.executions.append((statement, parameters))
+
+
+class QueryBudgetMixin:
+    """TestCase mixin adding `assertMaxQueries`."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """Fail if the block runs more than `budget` SQL statements.
+
+            with self.assertMaxQueries(5):
+                client.get("/")
+        """
+
+        with QueryCounter() as queries:
+            yield queries
+
+        if len(queries) > budget:
+            self.fail(f"{len(queries)} queries run, budget was {budget}:\n"
+                      + "\n".join(queries.statements))
+
+
+# Lines of a plan that read a whole table: Postgres's "Seq Scan on messages"
+# and SQLite's "SCAN messages" (SEARCH is an index lookup).
+FULL_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'^\s*SCAN (\w+)', re.MULTILINE),
+}
+
+
+class QueryPlanMixin:
+    """TestCase mixin adding `assertNoFullScans`."""
+
+    @contextmanager
+    def assertNoFullScans(self, *tables):
+        """Fail if a SELECT run in the block reads all of one of `tables`.
+
+            with self.assertNoFullScans('messages', 'likes'):
+                client.get("/")
+
+        Each statement is EXPLAINed after the block, so seed the tables and
+        ANALYZE them first: planners rightly scan tables they think small.
+        """
+
+        with QueryCounter() as queries:
+            yield queries
+
+        pattern = FULL_SCAN[db.engine.dialect.name]
+        with db.engine.connect() as conn:
+            for statement, parameters in queries.executions:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+
+                plan = explain(conn, statement, parameters)
+                scanned = set(pattern.findall(plan)) & set(tables)
+                if scanned:
+                    self.fail(f"Full scan of {', '.join(sorted(scanned))}:\n"
+                              f"{statement}\n{plan}")